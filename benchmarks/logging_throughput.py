@@ -0,0 +1,87 @@
+"""Measures dataref updates per second through Exchange.send_dataref_write with each log handler.
+
+Usage: python benchmarks/logging_throughput.py [updates]
+
+Log output goes to /dev/null, or to a pipe drained slowly by a child process to simulate a stalled terminal.
+"""
+import logging
+import os
+import subprocess
+import sys
+import time
+from kcontroller import PollableQueue
+from kcontroller.async_logging import AsyncStreamHandler
+from kcontroller.dataref import Dataref
+from kcontroller.exchanges import Exchange
+
+FORMAT = "%(asctime)s [%(process)d] [%(levelname)s] [%(module)s] %(message)s"
+SLOW_READER = "import sys, time\nwhile sys.stdin.read(4096):\n    time.sleep(0.001)\n"
+
+
+class _CountingStream(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.lines = 0
+
+    def write(self, data):
+        self.lines += data.count("\n")
+        self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+
+class _BenchmarkDriver(object):
+    def __init__(self):
+        self.queue = PollableQueue()
+
+    def get_inbound_queue(self):
+        return self.queue
+
+
+def _measure(handler, level, updates):
+    root = logging.getLogger()
+    handler.setFormatter(logging.Formatter(FORMAT))
+    root.handlers = [handler]
+    root.setLevel(level)
+
+    driver = _BenchmarkDriver()
+    exchange = Exchange(panel_drivers=[driver])
+    start = time.time()
+    for value in xrange(updates):
+        exchange.send_dataref_write("benchmark/value", value)
+        driver.queue.get()
+    elapsed = time.time() - start
+    handler.close()
+    return updates / elapsed
+
+
+def run(updates):
+    Dataref.register("benchmark/value", Dataref.TYPE_FLOAT)
+    for output in ("devnull", "slow pipe"):
+        for level in (logging.INFO, logging.DEBUG):
+            for handler_name in ("StreamHandler", "AsyncStreamHandler"):
+                reader = None
+                if output == "devnull":
+                    stream = open(os.devnull, "w")
+                else:
+                    reader = subprocess.Popen([sys.executable, "-c", SLOW_READER], stdin=subprocess.PIPE)
+                    stream = reader.stdin
+                stream = _CountingStream(stream)
+                if handler_name == "StreamHandler":
+                    handler = logging.StreamHandler(stream)
+                else:
+                    handler = AsyncStreamHandler(stream)
+                rate = _measure(handler, level, updates)
+                stream.close()
+                if reader:
+                    reader.wait()
+                sys.stderr.write("%-9s %-5s %-18s %8.0f updates/s %8s lines written\n"
+                                 % (output, logging.getLevelName(level), handler_name, rate, stream.lines))
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
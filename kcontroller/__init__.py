@@ -1,23 +1,66 @@
 from Queue import Queue
+import errno
+import select
 import socket
-import threading
 
 
 class PollableQueue(Queue):
     def __init__(self, maxsize=0):
         Queue.__init__(self, maxsize=maxsize)
         self._put_socket, self._get_socket = socket.socketpair()
-        self._lock = threading.Lock()
 
     def fileno(self):
         return self._get_socket.fileno()
 
+    # no lock around the socket: a put blocked on a full socketpair must not keep get from draining it.
+    # Every byte is sent after its item is queued, so a get that read one always finds an item.
     def put(self, item, block=True, timeout=None):
-        with self._lock:
-            Queue.put(self, item, block=block, timeout=timeout)
-            self._put_socket.send(b'x')
+        Queue.put(self, item, block=block, timeout=timeout)
+        self._put_socket.send(b'x')
 
     def get(self, block=True, timeout=None):
-        with self._lock:
-            self._get_socket.recv(1)
-            return Queue.get(self, block=block, timeout=timeout)
+        self._get_socket.recv(1)
+        return Queue.get(self, block=block, timeout=timeout)
+
+
+class SendBuffer(object):
+    """Buffers data for a non-blocking socket, writing as much as the socket accepts on each flush.
+
+    A peer that lets more than max_size bytes pile up unread is considered stalled, and write raises
+    IOError(ENOBUFS) so the caller can drop it instead of blocking on it.
+    """
+
+    def __init__(self, connection, max_size=1 << 20):
+        self._socket = connection
+        self._max_size = max_size
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer.extend(data)
+        if len(self._buffer) > self._max_size:
+            raise IOError(errno.ENOBUFS, "peer stalled with %s bytes unsent" % len(self._buffer))
+
+    def wants_write(self):
+        return len(self._buffer) > 0
+
+    def flush(self):
+        """Return True once everything was written."""
+        while self._buffer:
+            try:
+                sent = self._socket.send(self._buffer)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
+            del self._buffer[:sent]
+        return True
+
+
+def poll(poller, timeout=None):
+    # signals, such as the profiler toggle, can land on any thread and interrupt its poll
+    try:
+        return poller.poll(timeout)
+    except select.error as e:
+        if e.args[0] == errno.EINTR:
+            return []
+        raise
@@ -0,0 +1,106 @@
+from collections import deque
+import logging
+import threading
+import time
+
+
+class AsyncHandler(logging.Handler):
+    """Hands log records to a background writer thread so logging never blocks the real-time loops.
+
+    Records are formatted by the writer thread. When more than queue_size records are waiting, records
+    are dropped rather than waited for, and the number of dropped records is logged once the writer
+    catches up.
+    """
+
+    def __init__(self, target, queue_size=1024, batch_interval=0.01):
+        logging.Handler.__init__(self)
+        self._target = target
+        self._queue_size = queue_size
+        self._batch_interval = batch_interval
+        # deque appends and pops are atomic, so the hot path takes no lock
+        self._records = deque()
+        self._wakeup = threading.Event()
+        self._dropped = 0
+        self._closing = False
+        self._writer = threading.Thread(target=self._write_records, name="AsyncLogWriter")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self._target.setFormatter(fmt)
+
+    def handle(self, record):
+        # emit is thread safe on its own, skip the handler lock logging.Handler.handle would take
+        if self.filter(record):
+            self.emit(record)
+        return record
+
+    def emit(self, record):
+        if len(self._records) >= self._queue_size:
+            # only ever approximate, an increment can be lost to a concurrent writer
+            self._dropped += 1
+            return
+        self._records.append(record)
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+    def close(self):
+        if self._writer.is_alive():
+            self._closing = True
+            self._wakeup.set()
+            self._writer.join()
+        self._target.close()
+        logging.Handler.close(self)
+
+    def _write_records(self):
+        while True:
+            self._wakeup.wait()
+            # let records pile up so the writer takes the interpreter lock once per batch, not per record
+            time.sleep(self._batch_interval)
+            self._wakeup.clear()
+            while self._records:
+                records = []
+                while self._records and len(records) < self._queue_size:
+                    records.append(self._records.popleft())
+                dropped, self._dropped = self._dropped, 0
+                if dropped:
+                    records.insert(0, self._make_dropped_record(records[0], dropped))
+                self._write_batch(records)
+            if self._closing:
+                break
+
+    def _write_batch(self, records):
+        for record in records:
+            self._target.handle(record)
+
+    def _make_dropped_record(self, record, dropped):
+        return logging.makeLogRecord({
+            "name": record.name,
+            "levelno": logging.WARNING,
+            "levelname": logging.getLevelName(logging.WARNING),
+            "module": __name__.rsplit(".", 1)[-1],
+            "msg": "log queue overflowed, dropped %s record(s)",
+            "args": (dropped, ),
+        })
+
+
+class AsyncStreamHandler(AsyncHandler):
+    def __init__(self, stream=None, queue_size=1024, batch_interval=0.01):
+        AsyncHandler.__init__(self, logging.StreamHandler(stream), queue_size=queue_size,
+                              batch_interval=batch_interval)
+
+    def _write_batch(self, records):
+        # one write and flush for everything that queued up, instead of a flush per record
+        lines = []
+        for record in records:
+            try:
+                lines.append(self._target.format(record))
+            except Exception:
+                self._target.handleError(record)
+        if lines:
+            try:
+                self._target.stream.write("\n".join(lines) + "\n")
+                self._target.flush()
+            except Exception:
+                self._target.handleError(records[-1])
@@ -0,0 +1,169 @@
+import logging
+from operator import itemgetter
+from kcontroller.dataref import Dataref, DatarefFloat
+
+
+class DerivedDataref(object):
+    _data_types = {
+        "integer": Dataref.TYPE_INTEGER,
+        "int": Dataref.TYPE_INTEGER,
+        "float": Dataref.TYPE_FLOAT,
+    }
+
+    _expression_builtins = {
+        "abs": abs,
+        "bool": bool,
+        "float": float,
+        "int": int,
+        "max": max,
+        "min": min,
+        "round": round,
+    }
+
+    def __init__(self, name, data_type, expression, inputs):
+        if data_type not in DerivedDataref._data_types:
+            raise ValueError("unsupported type '%s' for derived dataref %s" % (data_type, name))
+        if not inputs:
+            raise ValueError("derived dataref %s has no inputs" % name)
+        self._name = name
+        self._data_type = DerivedDataref._data_types[data_type]
+        self._expression = expression
+        # expression variable name -> dataref name, sorted so the compiled function has a stable signature
+        self._inputs = sorted(inputs.items())
+        self._function = eval(compile("lambda %s: %s" % (", ".join(var for var, _ in self._inputs), expression),
+                                      "<derived dataref %s>" % name, "eval"),
+                              {"__builtins__": DerivedDataref._expression_builtins})
+
+    def get_name(self):
+        return self._name
+
+    def get_data_type(self):
+        return self._data_type
+
+    def get_input_names(self):
+        return [input_name for _, input_name in self._inputs]
+
+    def get_function(self):
+        return self._function
+
+    def __str__(self):
+        return "<%s %s=%s>" % (self.__class__.__name__, self._name, self._expression)
+
+
+class DerivedDatarefEngine(object):
+    """Computes derived datarefs from the values an exchange receives.
+
+    Every input and derived dataref owns a slot in one columnar value list. Definitions are compiled
+    once into a plan ordered so that derived datarefs can use other derived datarefs as inputs. Each
+    evaluation walks the plan once, only recomputing steps whose inputs changed since the last one,
+    and returns the derived values that changed as a result.
+    """
+
+    def __init__(self, derived_datarefs):
+        self._derived_datarefs = dict((derived.get_name(), derived) for derived in derived_datarefs)
+        self._slots = {}
+        self._values = []
+        self._changed = []
+        self._plan = []
+
+        for derived in self._sort_by_dependencies(derived_datarefs):
+            input_slots = [self._get_slot(input_name) for input_name in derived.get_input_names()]
+            if len(input_slots) == 1:
+                # itemgetter returns a bare value rather than a tuple for a single index
+                single_getter = itemgetter(input_slots[0])
+                getter = lambda values, single_getter=single_getter: (single_getter(values), )
+            else:
+                getter = itemgetter(*input_slots)
+            self._plan.append((self._get_slot(derived.get_name()), derived, getter))
+
+        # inputs are left unregistered so the panels using them decide their type, their slots hold raw values
+        for name in self._derived_datarefs:
+            Dataref.register(name, self._derived_datarefs[name].get_data_type())
+
+    @staticmethod
+    def from_config(derived_dataref_configs):
+        return DerivedDatarefEngine([DerivedDataref(config["name"], config.get("type", "float"),
+                                                    config["expression"], config.get("inputs", {}))
+                                     for config in derived_dataref_configs])
+
+    def is_derived(self, name):
+        return name in self._derived_datarefs
+
+    def is_input(self, name):
+        return name in self._slots and name not in self._derived_datarefs
+
+    def get_source_dataref(self, name, value=None):
+        """Return a dataref for a source, of its registered type or float, without registering a type for it."""
+        try:
+            return Dataref.factory(name, value)
+        except KeyError:
+            return DatarefFloat(name, value)
+
+    def get_source_names(self, name):
+        """Return the non-derived datarefs a derived dataref is ultimately computed from."""
+        source_names = set()
+        for input_name in self._derived_datarefs[name].get_input_names():
+            if input_name in self._derived_datarefs:
+                source_names.update(self.get_source_names(input_name))
+            else:
+                source_names.add(input_name)
+        return source_names
+
+    def get_value(self, name):
+        return self._values[self._slots[name]]
+
+    def update(self, name, value):
+        slot = self._slots.get(name)
+        if slot is not None and self._values[slot] != value:
+            self._values[slot] = value
+            self._changed[slot] = True
+
+    def evaluate(self):
+        values = self._values
+        changed = self._changed
+        changed_derived = []
+        for output_slot, derived, getter in self._plan:
+            arguments = getter(changed)
+            if not any(arguments):
+                continue
+            arguments = getter(values)
+            if None in arguments:
+                continue
+            try:
+                value = derived.get_function()(*arguments)
+            except Exception as e:
+                logging.warning("unable to compute derived dataref %s: %s", derived.get_name(), e)
+                continue
+            if value != values[output_slot]:
+                values[output_slot] = value
+                changed[output_slot] = True
+                changed_derived.append((derived.get_name(), value))
+        self._changed = [False] * len(changed)
+        return changed_derived
+
+    def _get_slot(self, name):
+        if name not in self._slots:
+            self._slots[name] = len(self._values)
+            self._values.append(None)
+            self._changed.append(False)
+        return self._slots[name]
+
+    def _sort_by_dependencies(self, derived_datarefs):
+        sorted_derived = []
+        visiting = set()
+
+        def visit(derived):
+            if derived in sorted_derived:
+                return
+            if derived.get_name() in visiting:
+                raise ValueError("derived dataref %s depends on itself" % derived.get_name())
+            visiting.add(derived.get_name())
+            for input_name in derived.get_input_names():
+                if input_name in self._derived_datarefs:
+                    visit(self._derived_datarefs[input_name])
+            visiting.remove(derived.get_name())
+            sorted_derived.append(derived)
+
+        for derived in derived_datarefs:
+            visit(derived)
+        return sorted_derived
@@ -1,68 +1,79 @@
+from collections import OrderedDict
 import logging
 import select
+import time
 from kcontroller import packets
 from kcontroller.dataref import Dataref
+from kcontroller.exchanges.router import ExchangeRouter, ExchangeRoute
 
 
 class Exchange(object):
-    def __init__(self, panel_drivers=None):
+    def __init__(self, panel_drivers=None, derived_datarefs=None):
         self._panel_drivers = panel_drivers if panel_drivers else []
+        self._derived_datarefs = derived_datarefs
+        self._simulation_listener = None
 
         self._poller = select.poll()
 
-    def _get_panel_driver_queue_by_fileno(self, fileno):
-        for panel_driver in self._panel_drivers:
-            queue = panel_driver.get_outbound_queue()
-            if fileno == queue.fileno():
-                return queue
-        return None
-
     def run(self):
-        for panel_driver in self._panel_drivers:
-            self._poller.register(panel_driver.get_outbound_queue(), select.POLLIN)
+        router = ExchangeRouter(self._panel_drivers, [ExchangeRoute(self.__class__.__name__, self)],
+                                derived_datarefs=self._derived_datarefs)
+        router.run()
+
+    def start(self, poller, simulation_listener=None):
+        # the router hands every exchange a poller feeding its own event loop, and decides what the panels
+        # are told about the simulation state from the state of all its exchanges
+        self._poller = poller
+        self._simulation_listener = simulation_listener
         self._init()
-        try:
-            while True:
-                ready_list = self._poller.poll()
-                if len(ready_list):
-                    reduced_ready_list = []
-                    for ready in ready_list:
-                        panel_driver_queue = self._get_panel_driver_queue_by_fileno(ready[0])
-                        if panel_driver_queue:
-                            packet = panel_driver_queue.get()
-                            try:
-                                self._handle_panel_packet(packet)
-                            except Exception as e:
-                                logging.error("exchange failed to handle panel packet %s: %s"
-                                              % (packet.__class__, e.message))
-                        else:
-                            reduced_ready_list.append(ready)
-                    if len(reduced_ready_list):
-                        self._handle_activity(reduced_ready_list)
-
-        except KeyboardInterrupt:
-            logging.info("Shutting down...")
-
-            self.send_packet_to_panel_drivers(packets.Shutdown())
-
-            for panel_driver in self._panel_drivers:
-                panel_driver.join()
-
-        logging.debug("Panel drivers shut down successfully")
+
+    def stop(self):
         self._finish()
-        logging.info("Shutdown successful")
+
+    def handle_panel_packet(self, packet):
+        try:
+            self._handle_panel_packet(packet)
+        except Exception as e:
+            logging.error("exchange failed to handle panel packet %s: %s", packet.__class__, e.message)
+
+    def handle_activity(self, ready_list):
+        try:
+            self._handle_activity(ready_list)
+        except Exception as e:
+            logging.error("exchange %s failed to handle activity: %s", self.__class__.__name__, e)
+
+    def get_poll_timeout(self):
+        return self._get_poll_timeout()
+
+    def handle_timers(self):
+        try:
+            self._handle_timers()
+        except Exception as e:
+            logging.error("exchange %s failed to handle timers: %s", self.__class__.__name__, e)
 
     def send_dataref_write(self, name, value):
+        if self._derived_datarefs and self._derived_datarefs.is_input(name):
+            # exchanges such as the socket one receive strings, expressions get the value a panel would
+            try:
+                self._derived_datarefs.update(name, self._derived_datarefs.get_source_dataref(name, value).get_value())
+            except ValueError:
+                logging.warning("discarding derived dataref input %s with invalid value %r", name, value)
+                return
         try:
             dataref = Dataref.factory(name, value)
             self.send_packet_to_panel_drivers(packets.DataWrite(dataref))
         except KeyError:
-            logging.warning("discarding unregistered dataref write for %s" % name)
+            # derived dataref inputs no panel registered are expected here
+            if not self._derived_datarefs or not self._derived_datarefs.is_input(name):
+                logging.warning("discarding unregistered dataref write for %s", name)
         except NotImplementedError:
-            logging.warning("discarding dataref write for %s because of unsupported type" % name)
+            logging.warning("discarding dataref write for %s because of unsupported type", name)
 
     def send_packet_to_panel_drivers(self, packet):
-        logging.debug("Sending %s packet to panel drivers" % packet)
+        if self._simulation_listener and isinstance(packet, (packets.SimulationStart, packets.SimulationStop)):
+            self._simulation_listener(isinstance(packet, packets.SimulationStart))
+            return
+        logging.debug("Sending %s packet to panel drivers", packet)
         for panel_driver in self._panel_drivers:
             panel_driver.get_inbound_queue().put(packet)
 
@@ -77,3 +88,130 @@ class Exchange(object):
 
     def _handle_panel_packet(self, packet):
         pass
+
+    def _get_poll_timeout(self):
+        # milliseconds until _handle_timers needs to run, None to wait for activity only
+        return None
+
+    def _handle_timers(self):
+        # called after every pass of the event loop
+        pass
+
+
+class ReconnectingExchange(Exchange):
+    """An exchange holding one outgoing connection, reconnecting with exponential backoff when it drops.
+
+    Subclasses start a non-blocking connection in _open_connection, finish it in _handle_connected once
+    it is writable, and call _handle_open when the link can carry requests. Subscriptions are remembered
+    and sent again on every connection. Other requests made while disconnected are dropped, since they
+    would be stale by the time the link is back.
+    """
+
+    def __init__(self, peer, reconnect_interval=2.0, max_reconnect_interval=None, *args, **kwargs):
+        super(ReconnectingExchange, self).__init__(*args, **kwargs)
+        self._peer = peer
+        self._reconnect_interval = reconnect_interval
+        self._max_reconnect_interval = (max_reconnect_interval if max_reconnect_interval is not None
+                                        else reconnect_interval)
+        self._retry_interval = reconnect_interval
+        self._next_connect = None
+        self._connection = None
+        self._connected = False
+        self._open = False
+        self._subscriptions = OrderedDict()
+        self._pending_requests = []
+
+    def _init(self):
+        self._connect()
+
+    def _finish(self):
+        if self._connection:
+            self._close()
+
+    def _connect(self):
+        logging.debug("%s connecting to %s", self.__class__.__name__, self._peer)
+        self._next_connect = None
+        try:
+            self._connection = self._open_connection()
+        except IOError as e:
+            logging.warning("%s unable to connect to %s: %s", self.__class__.__name__, self._peer, e)
+            self._schedule_reconnect()
+            return
+        # writable once the connection is established or failed
+        self._poller.register(self._connection, select.POLLOUT)
+
+    def _close(self):
+        self._poller.unregister(self._connection)
+        self._connection.close()
+        self._connection = None
+
+    def _disconnect(self):
+        if self._open:
+            logging.info("%s lost connection to %s", self.__class__.__name__, self._peer)
+            self.send_packet_to_panel_drivers(packets.SimulationStop())
+        if self._connection:
+            self._close()
+        self._connected = False
+        self._open = False
+        self._pending_requests = []
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        self._next_connect = time.time() + self._retry_interval
+        self._retry_interval = min(self._retry_interval * 2, self._max_reconnect_interval)
+
+    def _handle_open(self):
+        logging.info("%s connected to %s, resubscribing %s dataref(s)", self.__class__.__name__, self._peer,
+                     len(self._subscriptions))
+        self._open = True
+        self._retry_interval = self._reconnect_interval
+        self._pending_requests = list(self._subscriptions.values())
+
+    def _queue_request(self, request, subscription=None):
+        if subscription is not None:
+            self._subscriptions[subscription] = request
+        if self._open:
+            self._pending_requests.append(request)
+        elif subscription is None:
+            logging.debug("%s not connected, dropping %s", self.__class__.__name__, request)
+
+    def _get_poll_timeout(self):
+        if self._next_connect is None:
+            return None
+        return max(0, (self._next_connect - time.time()) * 1000)
+
+    def _handle_timers(self):
+        if self._next_connect is not None and time.time() >= self._next_connect:
+            self._connect()
+        elif self._open and len(self._pending_requests):
+            # everything the panels asked for during this pass goes out together
+            requests, self._pending_requests = self._pending_requests, []
+            self._send_requests(requests)
+
+    def _handle_activity(self, ready_list):
+        for ready in ready_list:
+            if not self._connection or ready[0] != self._connection.fileno():
+                continue
+            if not self._connected:
+                self._connected = True
+                try:
+                    self._handle_connected()
+                except IOError as e:
+                    logging.warning("%s unable to connect to %s: %s", self.__class__.__name__, self._peer, e)
+                    self._disconnect()
+                continue
+            self._handle_connection_activity(ready[1])
+
+    def _open_connection(self):
+        # start a non-blocking connection and return what to poll for it
+        raise NotImplementedError()
+
+    def _handle_connected(self):
+        # the connection became writable, raise IOError if it failed
+        pass
+
+    def _handle_connection_activity(self, event):
+        pass
+
+    def _send_requests(self, requests):
+        pass
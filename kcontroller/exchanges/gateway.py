@@ -0,0 +1,110 @@
+import errno
+import logging
+import socket
+import select
+from kcontroller import gateway, packets
+from kcontroller.exchanges import ReconnectingExchange
+
+
+class GatewayExchange(ReconnectingExchange):
+    """Connects the panel drivers of a remote node to a central controller's GatewayPanelDriver.
+
+    Everything the local panels send during one pass of the event loop goes out as a single frame.
+    When the link drops the panels are told the simulation stopped, and once it is back all their
+    subscriptions are replayed so the central controller sends the current values again.
+    """
+
+    def __init__(self, central_address, reconnect_interval=2.0, *args, **kwargs):
+        super(GatewayExchange, self).__init__("%s:%s" % tuple(central_address), *args,
+                                              reconnect_interval=reconnect_interval, **kwargs)
+        self._central_address = tuple(central_address)
+        self._reader = None
+        self._writer = None
+
+    def _open_connection(self):
+        connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        connection.setblocking(0)
+        error = connection.connect_ex(self._central_address)
+        if error not in (0, errno.EINPROGRESS):
+            connection.close()
+            raise socket.error(error, errno.errorcode.get(error, error))
+        return connection
+
+    def _handle_connected(self):
+        error = self._connection.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise socket.error(error, errno.errorcode.get(error, error))
+        self._connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._poller.modify(self._connection, select.POLLIN)
+        self._reader = gateway.FrameReader()
+        self._writer = gateway.FrameWriter(self._connection)
+        self._handle_open()
+
+    def _send_requests(self, entries):
+        self._flush(entries)
+
+    def _flush(self, entries=None):
+        try:
+            if entries:
+                self._writer.write(entries)
+            flushed = self._writer.flush()
+        except (IOError, socket.error) as e:
+            logging.warning("Gateway send failed: %s", e)
+            self._disconnect()
+            return
+        # keep the loop going while the central controller drains the link
+        self._poller.modify(self._connection, select.POLLIN if flushed else select.POLLIN | select.POLLOUT)
+
+    def _handle_connection_activity(self, event):
+        if event & select.POLLOUT:
+            self._flush()
+            if not self._connection or not event & (select.POLLIN | select.POLLHUP):
+                return
+        try:
+            data = self._connection.recv(65536) if not event & select.POLLHUP else ""
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            logging.warning("Gateway receive failed: %s", e)
+            data = ""
+        if not data:
+            self._disconnect()
+            return
+        self._reader.feed(data)
+        try:
+            entries = self._reader.read_entries()
+        except Exception as e:
+            logging.error("Gateway received an invalid frame: %s", e)
+            self._disconnect()
+            return
+        for entry in entries:
+            self._handle_entry(entry)
+
+    def _handle_entry(self, entry):
+        kind = entry[0]
+        if kind == gateway.ENTRY_UPDATE:
+            self.send_dataref_write(entry[1], entry[2])
+        elif kind == gateway.ENTRY_SIMULATION:
+            self.send_packet_to_panel_drivers(packets.SimulationStart() if entry[1] else packets.SimulationStop())
+        else:
+            logging.warning("Gateway discarding unsupported entry %s", kind)
+
+    def _handle_panel_packet(self, packet):
+        logging.debug("Gateway handling panel packet '%s'", packet.__class__.__name__)
+        if isinstance(packet, packets.DataSubscribeRequest):
+            dataref = packet.get_dataref()
+            entry = [gateway.ENTRY_SUBSCRIBE, dataref.get_name(), gateway.get_data_type(dataref)]
+        elif isinstance(packet, packets.DataWrite):
+            dataref = packet.get_dataref()
+            entry = [gateway.ENTRY_WRITE, dataref.get_name(), dataref.get_value()]
+        elif isinstance(packet, packets.CommandBegin):
+            entry = [gateway.ENTRY_COMMAND, packet.get_command().get_name(), "begin"]
+        elif isinstance(packet, packets.CommandEnd):
+            entry = [gateway.ENTRY_COMMAND, packet.get_command().get_name(), "end"]
+        elif isinstance(packet, packets.CommandOnce):
+            entry = [gateway.ENTRY_COMMAND, packet.get_command().get_name(), "once"]
+        else:
+            raise NotImplementedError("exchange %s does not implement packet of type %s"
+                                      % (self.__class__, packet.__class__))
+        # subscriptions are sent again on reconnection, so the central controller sends the current values
+        self._queue_request(entry, subscription=entry[1] if entry[0] == gateway.ENTRY_SUBSCRIBE else None)
@@ -1,21 +1,33 @@
+from collections import OrderedDict
+import errno
 import logging
 import socket
 import select
-from kcontroller import packets
+from kcontroller import packets, SendBuffer
 from kcontroller.dataref import DatarefInteger, DatarefFloat, DatarefCommand
 from kcontroller.exchanges import Exchange
 
 
 class InetSocketExchange(Exchange):
-    def __init__(self, bind_address, *args, **kwargs):
+    """Serves one client over a line based socket protocol.
+
+    The connection never blocks the router: packets are buffered and written as the client reads them,
+    and a client leaving more than max_send_buffer_size bytes unread is disconnected. Registrations are
+    remembered and sent to every client when it connects.
+    """
+
+    def __init__(self, bind_address, max_send_buffer_size=1 << 20, *args, **kwargs):
         super(InetSocketExchange, self).__init__(*args, **kwargs)
-        self._bind_address = bind_address
+        self._bind_address = tuple(bind_address)
+        self._max_send_buffer_size = max_send_buffer_size
         self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._connection = None
         self._connection_address = None
+        self._writer = None
+        self._registrations = OrderedDict()
 
     def _init(self):
-        logging.debug("Exchange listening on port %s" % self._bind_address[1])
+        logging.debug("Exchange listening on port %s", self._bind_address[1])
         self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._server_socket.bind(self._bind_address)
         self._server_socket.listen(5)
@@ -34,26 +46,60 @@ class InetSocketExchange(Exchange):
         for ready in ready_list:
             if not self._connection and ready[0] == self._server_socket.fileno():
                 self._connection, self._connection_address = self._server_socket.accept()
-                logging.info("Accepted exchange connection from %s" % repr(self._connection_address))
+                logging.info("Accepted exchange connection from %s", repr(self._connection_address))
+                self._connection.setblocking(0)
+                self._writer = SendBuffer(self._connection, max_size=self._max_send_buffer_size)
                 self._poller.register(self._connection, select.POLLIN)
                 self.send_packet_to_panel_drivers(packets.SimulationStart())
+                for payload in self._registrations.values():
+                    self._write(payload)
             elif self._connection and ready[0] == self._connection.fileno():
-                if ready[1] & select.POLLHUP:
-                    logging.info("Exchange connection %s hung up" % repr(self._connection_address))
-                    self._poller.unregister(self._connection)
-                    self.send_packet_to_panel_drivers(packets.SimulationStop())
-                    self._connection = None
-                    self._connection_address = None
-                else:
-                    payload = self._connection.recv(4096)
-                    logging.debug("Exchange connection received %s byte(s)" % len(payload))
-                    try:
-                        self._parse_payload(payload.strip())
-                    except Exception as e:
-                        logging.error("failed to parse exchange payload: %s" % e.message)
+                if ready[1] & select.POLLOUT:
+                    self._flush()
+                    if not self._connection or not ready[1] & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                        continue
+                try:
+                    payload = self._connection.recv(4096) if not ready[1] & select.POLLHUP else ""
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        continue
+                    logging.warning("Exchange connection %s failed: %s", repr(self._connection_address), e)
+                    payload = ""
+                if not payload:
+                    self._close_connection()
+                    continue
+                logging.debug("Exchange connection received %s byte(s)", len(payload))
+                try:
+                    self._parse_payload(payload.strip())
+                except Exception as e:
+                    logging.error("failed to parse exchange payload: %s", e.message)
+
+    def _close_connection(self):
+        logging.info("Exchange connection %s hung up", repr(self._connection_address))
+        self._poller.unregister(self._connection)
+        self._connection.close()
+        self.send_packet_to_panel_drivers(packets.SimulationStop())
+        self._connection = None
+        self._connection_address = None
+        self._writer = None
+
+    def _handle_timers(self):
+        # everything the panels sent during this pass goes out together
+        if self._writer and self._writer.wants_write():
+            self._flush()
+
+    def _flush(self):
+        try:
+            flushed = self._writer.flush()
+        except (IOError, socket.error) as e:
+            logging.warning("Exchange connection %s failed: %s", repr(self._connection_address), e)
+            self._close_connection()
+            return
+        # wait for the client to read instead of blocking every other route on it
+        self._poller.modify(self._connection, select.POLLIN if flushed else select.POLLIN | select.POLLOUT)
 
     def _parse_payload(self, payload):
-        logging.debug("Handling exchange connection payload '%s'" % payload)
+        logging.debug("Handling exchange connection payload '%s'", payload)
         if payload.startswith("update "):
             data_tuples = payload[7:].split(",")
             for data_tuple in data_tuples:
@@ -61,7 +107,7 @@ class InetSocketExchange(Exchange):
                 self.send_dataref_write(name, value)
 
     def _handle_panel_packet(self, packet):
-        logging.debug("Exchange handling panel packet '%s'" % packet.__class__.__name__)
+        logging.debug("Exchange handling panel packet '%s'", packet.__class__.__name__)
         if isinstance(packet, packets.DataSubscribeRequest):
             dataref = packet.get_dataref()
             if isinstance(dataref, DatarefInteger):
@@ -74,6 +120,7 @@ class InetSocketExchange(Exchange):
                 raise NotImplementedError("exchange %s does not implement dataref type %s"
                                           % (self.__class__, dataref.__class__))
             payload = "register %s %s" % (dataref.get_name(), data_type)
+            self._registrations[dataref.get_name()] = payload
         elif isinstance(packet, packets.DataWrite):
             dataref = packet.get_dataref()
             payload = "update %s %s" % (dataref.get_name(), dataref.get_value())
@@ -89,4 +136,15 @@ class InetSocketExchange(Exchange):
         else:
             raise NotImplementedError("exchange %s does not implement packet of type %s"
                                       % (self.__class__, packet.__class__))
-        self._connection.sendall(payload + "\n")
+        if not self._connection:
+            logging.debug("Exchange not connected, dropping '%s'", payload)
+            return
+        self._write(payload)
+
+    def _write(self, payload):
+        try:
+            # names received from a gateway are unicode
+            self._writer.write((payload + "\n").encode("utf-8"))
+        except IOError as e:
+            logging.warning("Exchange connection %s stalled: %s", repr(self._connection_address), e)
+            self._close_connection()
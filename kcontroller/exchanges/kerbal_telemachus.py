@@ -1,12 +1,12 @@
 import json
 import logging
 import select
-from websocket import create_connection
 from kcontroller import packets
-from kcontroller.exchanges import Exchange
+from kcontroller.exchanges import ReconnectingExchange
+from kcontroller.exchanges.websocket_transport import WebSocketTransport
 
 
-class KerbalTelemachusExchange(Exchange):
+class KerbalTelemachusExchange(ReconnectingExchange):
     __dataref_map = {
         "sim/cockpit/sas/actuators/toggle": "f.stage",
         "sim/cockpit/sas/state": "v.sasValue",
@@ -15,32 +15,69 @@ class KerbalTelemachusExchange(Exchange):
 
     __key_map = dict((v, k) for k, v in __dataref_map.iteritems())
 
-    def __init__(self, ws_url, *args, **kwargs):
-        super(KerbalTelemachusExchange, self).__init__(*args, **kwargs)
+    def __init__(self, ws_url, compression=True, reconnect_interval=1.0, max_reconnect_interval=30.0,
+                 *args, **kwargs):
+        super(KerbalTelemachusExchange, self).__init__(ws_url, *args, reconnect_interval=reconnect_interval,
+                                                       max_reconnect_interval=max_reconnect_interval, **kwargs)
         self._ws_url = ws_url
-        self._ws = None
+        self._ws = WebSocketTransport(ws_url, compression=compression)
 
-    def _init(self):
-        self._ws = create_connection(self._ws_url)
-        self._poller.register(self._ws, select.POLLIN)
+    def _open_connection(self):
+        self._ws.connect()
+        return self._ws
 
-    def _finish(self):
-        self._poller.unregister(self._ws)
-        self._ws.close()
+    def _handle_connected(self):
+        # the link only opens once the server answered the handshake
+        self._ws.handle_connected()
+        self._flush()
 
-    def _handle_activity(self, ready_list):
-        for ready in ready_list:
-            if ready[0] == self._ws.fileno():
-                payload = self._ws.recv()
-                if payload:
-                    logging.debug("Exchange connection received %s byte(s)" % len(payload))
-                    try:
-                        self._parse_payload(payload.strip())
-                    except Exception as e:
-                        logging.error("failed to parse exchange payload: %s" % e.message)
+    def _handle_open(self):
+        super(KerbalTelemachusExchange, self)._handle_open()
+        self.send_packet_to_panel_drivers(packets.SimulationStart())
+
+    def _send_requests(self, requests):
+        request = {}
+        for entry, value in requests:
+            request.setdefault(entry, []).append(value)
+        self._ws.send(json.dumps(request, separators=(',', ':')))
+        self._flush()
+
+    def _flush(self):
+        try:
+            flushed = self._ws.flush()
+        except IOError as e:
+            logging.error("Exchange connection to %s failed: %s", self._ws_url, e)
+            self._disconnect()
+            return
+        # wait for the socket to drain instead of blocking the loop on a slow connection
+        self._poller.modify(self._ws, select.POLLIN if flushed else select.POLLIN | select.POLLOUT)
+
+    def _handle_connection_activity(self, event):
+        if event & select.POLLOUT:
+            self._flush()
+        if not self._connection or not event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+            return
+        was_open = self._ws.is_open()
+        try:
+            payloads = self._ws.receive()
+        except IOError as e:
+            logging.error("Exchange connection to %s closed: %s", self._ws_url, e)
+            self._disconnect()
+            return
+        if not was_open and self._ws.is_open():
+            self._handle_open()
+        for payload in payloads:
+            logging.debug("Exchange connection received %s byte(s)", len(payload))
+            try:
+                self._parse_payload(payload.strip())
+            except Exception as e:
+                logging.error("failed to parse exchange payload: %s", e.message)
+        if self._ws.wants_write():
+            # answer pings and closes without waiting for the next pass
+            self._flush()
 
     def _parse_payload(self, payload):
-        logging.debug("Handling exchange connection payload '%s'" % payload)
+        logging.debug("Handling exchange connection payload '%s'", payload)
         payload = json.loads(payload)
         for key in payload:
             dataref = self._get_dataref_for_key(key)
@@ -48,29 +85,30 @@ class KerbalTelemachusExchange(Exchange):
                 self.send_dataref_write(dataref, payload[key])
 
     def _handle_panel_packet(self, packet):
-        logging.debug("Exchange handling panel packet '%s'" % packet.__class__.__name__)
+        logging.debug("Exchange handling panel packet '%s'", packet.__class__.__name__)
         if isinstance(packet, packets.DataSubscribeRequest):
             key = self._get_key_for_dataref(packet.get_dataref().get_name())
-            payload = {"+": [key]}
+            # Telemachus keeps streaming what it was subscribed to, a panel registering again needs nothing new
+            if key not in self._subscriptions:
+                self._queue_request(("+", key), subscription=key)
         elif isinstance(packet, packets.DataWrite):
             dataref = packet.get_dataref()
-            payload = {"run": ["%s[%s]" % (dataref.get_name(), dataref.get_value())]}
+            self._queue_request(("run", "%s[%s]" % (dataref.get_name(), dataref.get_value())))
         elif isinstance(packet, packets.CommandOnce) or isinstance(packet, packets.CommandBegin):
-            command = packet.get_command()
-            payload = {"run": [command.get_name()]}
+            self._queue_request(("run", packet.get_command().get_name()))
         else:
             raise NotImplementedError("exchange %s does not implement packet of type %s"
                                       % (self.__class__, packet.__class__))
-        self._ws.send(json.dumps(payload, separators=(',', ':')))
 
+    # unmapped datarefs are passed through as Telemachus API keys, so derived datarefs can use any telemetry value
     @staticmethod
     def _get_dataref_for_key(key):
         if key in KerbalTelemachusExchange.__key_map:
             return KerbalTelemachusExchange.__key_map[key]
-        return None
+        return key
 
     @staticmethod
     def _get_key_for_dataref(name):
         if name in KerbalTelemachusExchange.__dataref_map:
             return KerbalTelemachusExchange.__dataref_map[name]
-        return None
+        return name
@@ -0,0 +1,192 @@
+import functools
+import logging
+import select
+from kcontroller import packets, poll, PollableQueue
+from kcontroller.dataref import Dataref
+
+
+class ExchangeRoute(object):
+    """An exchange hosted by the router along with the dataref name prefixes it owns.
+
+    Panel packets for a route are queued separately and handled a bounded number at a time, so a burst
+    of traffic for one exchange cannot hold back the others.
+    """
+
+    def __init__(self, name, exchange, prefixes=None):
+        self.name = name
+        self.exchange = exchange
+        self.prefixes = prefixes if prefixes else []
+        self.queue = PollableQueue()
+
+    def __str__(self):
+        return "<%s %s %s>" % (self.__class__.__name__, self.name, self.exchange.__class__.__name__)
+
+
+class _RoutePoller(object):
+    # stands in for the exchange's own poll object so its sockets end up in the router's poll loop
+    def __init__(self, poller, route, fileno_routes):
+        self._poller = poller
+        self._route = route
+        self._fileno_routes = fileno_routes
+
+    def register(self, fd, eventmask=select.POLLIN | select.POLLPRI | select.POLLOUT):
+        self._fileno_routes[_get_fileno(fd)] = self._route
+        self._poller.register(fd, eventmask)
+
+    def modify(self, fd, eventmask):
+        self._poller.modify(fd, eventmask)
+
+    def unregister(self, fd):
+        self._fileno_routes.pop(_get_fileno(fd), None)
+        self._poller.unregister(fd)
+
+
+def _get_fileno(fd):
+    return fd if isinstance(fd, (int, long)) else fd.fileno()
+
+
+class ExchangeRouter(object):
+    def __init__(self, panel_drivers, routes, derived_datarefs=None, packet_budget=16):
+        self._panel_drivers = panel_drivers if panel_drivers else []
+        self._routes = routes
+        self._derived_datarefs = derived_datarefs
+        self._packet_budget = packet_budget
+        self._poller = select.poll()
+        self._fileno_routes = {}
+        self._route_cache = {}
+        self._subscribed_source_names = set()
+        self._running_routes = set()
+        self._panel_driver_queues = {}
+        self._route_queues = {}
+
+        default_routes = [route for route in routes if not route.prefixes]
+        self._default_route = default_routes[0] if default_routes else routes[0]
+        # longest prefix first so the most specific route wins
+        self._prefixes = sorted(((prefix, route) for route in routes for prefix in route.prefixes),
+                                key=lambda prefix_route: len(prefix_route[0]), reverse=True)
+
+    def get_route(self, name):
+        if name not in self._route_cache:
+            self._route_cache[name] = self._default_route
+            for prefix, route in self._prefixes:
+                if name.startswith(prefix):
+                    self._route_cache[name] = route
+                    break
+        return self._route_cache[name]
+
+    def run(self):
+        self._start()
+        try:
+            while True:
+                self._run_once(self._get_poll_timeout())
+
+        except KeyboardInterrupt:
+            logging.info("Shutting down...")
+
+            self._send_packet_to_panel_drivers(packets.Shutdown())
+
+            for panel_driver in self._panel_drivers:
+                panel_driver.join()
+
+        logging.debug("Panel drivers shut down successfully")
+        for route in self._routes:
+            route.exchange.stop()
+        logging.info("Shutdown successful")
+
+    def _start(self):
+        self._panel_driver_queues = {}
+        for panel_driver in self._panel_drivers:
+            queue = panel_driver.get_outbound_queue()
+            self._panel_driver_queues[queue.fileno()] = queue
+            self._poller.register(queue, select.POLLIN)
+        self._route_queues = {}
+        for route in self._routes:
+            self._route_queues[route.queue.fileno()] = route
+            self._poller.register(route.queue, select.POLLIN)
+            logging.info("Starting exchange route %s for %s", route,
+                         ", ".join(route.prefixes) if route.prefixes else "all other datarefs")
+            route.exchange.start(_RoutePoller(self._poller, route, self._fileno_routes),
+                                 simulation_listener=functools.partial(self._set_simulation_running, route))
+
+    def _run_once(self, timeout):
+        ready_list = poll(self._poller, timeout)
+        route_ready_lists = {}
+        for ready in ready_list:
+            if ready[0] in self._panel_driver_queues:
+                self._route_panel_packet(self._panel_driver_queues[ready[0]].get())
+            elif ready[0] in self._route_queues:
+                self._drain_route_queue(self._route_queues[ready[0]])
+            elif ready[0] in self._fileno_routes:
+                route_ready_lists.setdefault(self._fileno_routes[ready[0]], []).append(ready)
+        for route, route_ready_list in route_ready_lists.iteritems():
+            route.exchange.handle_activity(route_ready_list)
+        if len(route_ready_lists):
+            self._send_derived_dataref_writes()
+        for route in self._routes:
+            route.exchange.handle_timers()
+
+    def is_simulation_running(self):
+        return len(self._running_routes) > 0
+
+    def _set_simulation_running(self, route, running):
+        was_running = self.is_simulation_running()
+        if running:
+            self._running_routes.add(route)
+        else:
+            self._running_routes.discard(route)
+        logging.info("Exchange route %s simulation %s", route, "started" if running else "stopped")
+        # panels only stop once no exchange has a simulation running any more
+        if self.is_simulation_running() != was_running:
+            self._send_packet_to_panel_drivers(packets.SimulationStart() if running else packets.SimulationStop())
+
+    def _get_poll_timeout(self):
+        timeouts = [route.exchange.get_poll_timeout() for route in self._routes]
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        return min(timeouts) if timeouts else None
+
+    def _route_panel_packet(self, packet):
+        if isinstance(packet, (packets.DataSubscribeRequest, packets.DataWrite)):
+            name = packet.get_dataref().get_name()
+        elif isinstance(packet, (packets.CommandBegin, packets.CommandEnd, packets.CommandOnce)):
+            name = packet.get_command().get_name()
+        else:
+            name = None
+
+        if name is not None and self._derived_datarefs and self._derived_datarefs.is_derived(name):
+            self._handle_derived_panel_packet(name, packet)
+        elif name is not None:
+            self.get_route(name).queue.put(packet)
+        else:
+            for route in self._routes:
+                route.queue.put(packet)
+
+    def _drain_route_queue(self, route):
+        # whatever is left keeps the queue readable and gets handled on the next pass of the loop
+        for _ in xrange(self._packet_budget):
+            route.exchange.handle_panel_packet(route.queue.get())
+            if route.queue.empty():
+                break
+
+    def _handle_derived_panel_packet(self, name, packet):
+        if not isinstance(packet, packets.DataSubscribeRequest):
+            logging.warning("discarding %s for derived dataref %s", packet.__class__.__name__, name)
+            return
+        for source_name in self._derived_datarefs.get_source_names(name):
+            if source_name not in self._subscribed_source_names:
+                self._subscribed_source_names.add(source_name)
+                self._route_panel_packet(
+                    packets.DataSubscribeRequest(self._derived_datarefs.get_source_dataref(source_name)))
+        value = self._derived_datarefs.get_value(name)
+        if value is not None:
+            self._send_packet_to_panel_drivers(packets.DataWrite(Dataref.factory(name, value)))
+
+    def _send_derived_dataref_writes(self):
+        if not self._derived_datarefs:
+            return
+        for name, value in self._derived_datarefs.evaluate():
+            self._send_packet_to_panel_drivers(packets.DataWrite(Dataref.factory(name, value)))
+
+    def _send_packet_to_panel_drivers(self, packet):
+        logging.debug("Sending %s packet to panel drivers", packet)
+        for panel_driver in self._panel_drivers:
+            panel_driver.get_inbound_queue().put(packet)
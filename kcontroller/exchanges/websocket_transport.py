@@ -0,0 +1,292 @@
+import base64
+import errno
+import hashlib
+import logging
+import os
+import socket
+import struct
+from urlparse import urlparse
+import zlib
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xa
+
+# a permessage-deflate message always ends with an empty stored block, which is left out on the wire
+DEFLATE_TRAILER = "\x00\x00\xff\xff"
+
+
+class WebSocketClosed(IOError):
+    pass
+
+
+class WebSocketTransport(object):
+    """Client websocket that never blocks.
+
+    connect() starts a non-blocking connection. Once the socket is writable, handle_connected() queues
+    the handshake, and receive() completes it before returning messages. receive() reads whatever is
+    available into a reusable buffer and returns only the messages that are complete, keeping partial
+    frames and fragmented messages for the next call. send() only queues a frame; flush() writes as
+    much of the queue as the socket accepts, so callers can batch everything they send during one pass
+    of their event loop. permessage-deflate is used when the server accepts it.
+    """
+
+    # the largest handshake response accepted, anything bigger is not a websocket server
+    MAX_HANDSHAKE_SIZE = 16384
+
+    def __init__(self, url, compression=True, compression_level=6, read_size=65536):
+        self._url = urlparse(url)
+        if self._url.scheme != "ws":
+            raise NotImplementedError("unsupported websocket scheme %s" % self._url.scheme)
+        self._compression = compression
+        self._compression_level = compression_level
+        self._socket = None
+        self._read_chunk = bytearray(read_size)
+        self._reset()
+
+    def _reset(self):
+        self._buffer = bytearray()
+        self._send_buffer = bytearray()
+        self._fragments = []
+        self._fragment_opcode = None
+        self._fragment_compressed = False
+        self._deflate = None
+        self._compressor = None
+        self._decompressor = None
+        self._handshake_key = None
+        self._open = False
+        self._closed = False
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def is_compressed(self):
+        return self._deflate is not None
+
+    def is_connected(self):
+        """Return True once the TCP connection is up and the handshake was queued."""
+        return self._handshake_key is not None
+
+    def is_open(self):
+        return self._open
+
+    def connect(self):
+        self.close()
+        self._reset()
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setblocking(0)
+        error = self._socket.connect_ex((self._url.hostname, self._url.port if self._url.port else 80))
+        if error not in (0, errno.EINPROGRESS):
+            self.close()
+            raise socket.error(error, os.strerror(error))
+
+    def handle_connected(self):
+        """Queue the handshake once the socket became writable, raising if the connection failed."""
+        error = self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise socket.error(error, os.strerror(error))
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self._handshake_key = base64.b64encode(os.urandom(16))
+        request = [
+            "GET %s HTTP/1.1" % ((self._url.path or "/") + ("?" + self._url.query if self._url.query else "")),
+            "Host: %s" % self._url.netloc,
+            "Upgrade: websocket",
+            "Connection: Upgrade",
+            "Sec-WebSocket-Key: %s" % self._handshake_key,
+            "Sec-WebSocket-Version: 13",
+        ]
+        if self._compression:
+            request.append("Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits")
+        self._send_buffer.extend("\r\n".join(request) + "\r\n\r\n")
+
+    def close(self):
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+        self._handshake_key = None
+        self._open = False
+
+    def send(self, message, opcode=OPCODE_TEXT):
+        rsv1 = 0
+        if self._deflate and opcode in (OPCODE_TEXT, OPCODE_BINARY):
+            if self._deflate["client_no_context_takeover"] or not self._compressor:
+                self._compressor = zlib.compressobj(self._compression_level, zlib.DEFLATED,
+                                                    -self._deflate["client_max_window_bits"])
+            message = self._compressor.compress(message) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            if message.endswith(DEFLATE_TRAILER):
+                message = message[:-len(DEFLATE_TRAILER)]
+            rsv1 = 0x40
+        self._send_buffer.extend(self._build_frame(opcode, message, rsv1))
+
+    def wants_write(self):
+        return len(self._send_buffer) > 0
+
+    def flush(self):
+        """Write as much of the queued frames as possible, returning True once everything went out."""
+        while self._send_buffer:
+            try:
+                sent = self._socket.send(self._send_buffer)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
+            del self._send_buffer[:sent]
+        return True
+
+    def receive(self):
+        """Read what is available and return the complete messages it finished, oldest first."""
+        while True:
+            try:
+                received = self._socket.recv_into(self._read_chunk)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not received:
+                self._closed = True
+                break
+            self._buffer.extend(buffer(self._read_chunk, 0, received))
+            if received < len(self._read_chunk):
+                break
+
+        if not self._open and not self._complete_handshake():
+            if self._closed:
+                raise WebSocketClosed("connection closed during websocket handshake")
+            return []
+        messages = self._parse_frames()
+        if self._closed:
+            if messages:
+                # hand over what arrived before the close, report it on the next call
+                return messages
+            raise WebSocketClosed("websocket connection closed")
+        return messages
+
+    def _complete_handshake(self):
+        end = self._buffer.find("\r\n\r\n")
+        if end < 0:
+            if len(self._buffer) > WebSocketTransport.MAX_HANDSHAKE_SIZE:
+                raise IOError("websocket handshake response too large")
+            return False
+        lines = str(self._buffer[:end]).split("\r\n")
+        del self._buffer[:end + 4]
+
+        if len(lines[0].split(" ")) < 2 or lines[0].split(" ")[1] != "101":
+            raise IOError("websocket handshake refused: %s" % lines[0])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        expected_accept = base64.b64encode(hashlib.sha1(self._handshake_key + WEBSOCKET_GUID).digest())
+        if headers.get("sec-websocket-accept") != expected_accept:
+            raise IOError("websocket handshake returned an invalid accept key")
+        self._negotiate_extensions(headers.get("sec-websocket-extensions", ""))
+        self._open = True
+        logging.debug("Websocket connected to %s%s", self._url.netloc,
+                      " with permessage-deflate" if self._deflate else "")
+        return True
+
+    def _negotiate_extensions(self, extensions):
+        for extension in extensions.split(","):
+            parameters = [parameter.strip() for parameter in extension.split(";")]
+            if parameters[0] != "permessage-deflate":
+                continue
+            self._deflate = {
+                "client_no_context_takeover": False,
+                "server_no_context_takeover": False,
+                "client_max_window_bits": 15,
+            }
+            for parameter in parameters[1:]:
+                name, _, value = parameter.partition("=")
+                if name in ("client_no_context_takeover", "server_no_context_takeover"):
+                    self._deflate[name] = True
+                elif name == "client_max_window_bits" and value:
+                    # zlib refuses raw deflate streams with an 8 bit window
+                    self._deflate[name] = max(9, int(value.strip('"')))
+
+    def _parse_frames(self):
+        messages = []
+        buf = self._buffer
+        offset = 0
+        while len(buf) - offset >= 2:
+            first_byte, second_byte = buf[offset], buf[offset + 1]
+            length = second_byte & 0x7f
+            header_size = 2
+            if length == 126:
+                header_size += 2
+                if len(buf) - offset < header_size:
+                    break
+                length = struct.unpack_from("!H", buf, offset + 2)[0]
+            elif length == 127:
+                header_size += 8
+                if len(buf) - offset < header_size:
+                    break
+                length = struct.unpack_from("!Q", buf, offset + 2)[0]
+            mask = None
+            if second_byte & 0x80:
+                mask = buf[offset + header_size:offset + header_size + 4]
+                header_size += 4
+            if len(buf) - offset < header_size + length:
+                break
+
+            payload = buf[offset + header_size:offset + header_size + length]
+            offset += header_size + length
+            if mask:
+                payload = self._apply_mask(payload, mask)
+            message = self._handle_frame(first_byte & 0x80, first_byte & 0x40, first_byte & 0x0f, str(payload))
+            if message is not None:
+                messages.append(message)
+
+        del buf[:offset]
+        return messages
+
+    def _handle_frame(self, fin, rsv1, opcode, payload):
+        if opcode == OPCODE_PING:
+            self.send(payload, OPCODE_PONG)
+            return None
+        elif opcode == OPCODE_PONG:
+            return None
+        elif opcode == OPCODE_CLOSE:
+            if not self._closed:
+                self.send(payload[:2], OPCODE_CLOSE)
+            self._closed = True
+            return None
+
+        if opcode != OPCODE_CONTINUATION:
+            self._fragments = []
+            self._fragment_opcode = opcode
+            self._fragment_compressed = bool(rsv1)
+        self._fragments.append(payload)
+        if not fin:
+            return None
+
+        message = "".join(self._fragments)
+        self._fragments = []
+        if self._fragment_compressed:
+            if self._deflate["server_no_context_takeover"] or not self._decompressor:
+                self._decompressor = zlib.decompressobj(-15)
+            message = self._decompressor.decompress(message + DEFLATE_TRAILER)
+        return message
+
+    def _build_frame(self, opcode, payload, rsv1=0):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | rsv1 | opcode, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | rsv1 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | rsv1 | opcode, 0x80 | 127, length)
+        # clients must mask every frame they send
+        mask = bytearray(os.urandom(4))
+        return header + str(mask) + str(self._apply_mask(bytearray(payload), mask))
+
+    @staticmethod
+    def _apply_mask(payload, mask):
+        for index in xrange(len(payload)):
+            payload[index] ^= mask[index & 3]
+        return payload
@@ -0,0 +1,74 @@
+import json
+import struct
+import zlib
+from kcontroller import SendBuffer
+from kcontroller.dataref import Dataref, DatarefCommand, DatarefFloat, DatarefInteger
+
+FRAME_HEADER = struct.Struct("!IB")
+FLAG_COMPRESSED = 0x01
+# compressing smaller frames costs more than it saves
+COMPRESSION_THRESHOLD = 128
+# anything larger is a corrupt header or a misbehaving peer
+MAX_FRAME_SIZE = 1 << 20
+# a peer that lets this much pile up unread is considered stalled
+MAX_SEND_BUFFER_SIZE = 1 << 20
+
+ENTRY_SUBSCRIBE = "subscribe"
+ENTRY_WRITE = "write"
+ENTRY_COMMAND = "command"
+ENTRY_UPDATE = "update"
+ENTRY_SIMULATION = "simulation"
+
+
+def encode_frame(entries):
+    """Encode a batch of entries, each a list starting with one of the ENTRY_* kinds, into one frame."""
+    data = json.dumps(entries, separators=(',', ':'))
+    flags = 0
+    if len(data) > COMPRESSION_THRESHOLD:
+        data = zlib.compress(data)
+        flags |= FLAG_COMPRESSED
+    return FRAME_HEADER.pack(len(data), flags) + data
+
+
+class FrameReader(object):
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, data):
+        self._buffer += data
+
+    def read_entries(self):
+        entries = []
+        while len(self._buffer) >= FRAME_HEADER.size:
+            length, flags = FRAME_HEADER.unpack_from(self._buffer)
+            if length > MAX_FRAME_SIZE:
+                raise ValueError("frame of %s bytes exceeds the %s bytes limit" % (length, MAX_FRAME_SIZE))
+            end = FRAME_HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            data = self._buffer[FRAME_HEADER.size:end]
+            self._buffer = self._buffer[end:]
+            if flags & FLAG_COMPRESSED:
+                data = zlib.decompress(data)
+            entries.extend(json.loads(data))
+        return entries
+
+
+class FrameWriter(SendBuffer):
+    """Buffers frames for a non-blocking socket, writing as much as the socket accepts on each flush."""
+
+    def __init__(self, connection):
+        super(FrameWriter, self).__init__(connection, max_size=MAX_SEND_BUFFER_SIZE)
+
+    def write(self, entries):
+        super(FrameWriter, self).write(encode_frame(entries))
+
+
+def get_data_type(dataref):
+    if isinstance(dataref, DatarefInteger):
+        return Dataref.TYPE_INTEGER
+    elif isinstance(dataref, DatarefFloat):
+        return Dataref.TYPE_FLOAT
+    elif isinstance(dataref, DatarefCommand):
+        return Dataref.TYPE_COMMAND
+    raise NotImplementedError("gateway does not implement dataref type %s" % dataref.__class__)
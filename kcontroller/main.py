@@ -1,11 +1,16 @@
+import functools
+import importlib
 import logging
 import logging.config
+import resource
+import signal
+import sys
+import threading
+import time
 import pkg_resources
+import yaml
 from kcontroller import PollableQueue
-from kcontroller.exchanges.kerbal_telemachus import KerbalTelemachusExchange
-from kcontroller.exchanges.inet_socket import InetSocketExchange
-from kcontroller.panel_drivers.inet_socket import InetSocketPanelDriver
-from kcontroller.panel_drivers.teensy import TeensyPanelDriver
+from kcontroller.exchanges.router import ExchangeRouter, ExchangeRoute
 
 
 def _init_logging():
@@ -13,24 +18,111 @@ def _init_logging():
     logging.config.fileConfig(logging_conf_file, disable_existing_loggers=False)
 
 
+def _load_config(argv):
+    if len(argv) > 1:
+        config_file = argv[1]
+    else:
+        config_file = pkg_resources.resource_filename("kcontroller", "resources/config/kcontroller.yaml")
+    logging.info("Loading configuration from %s", config_file)
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+    return config if config else {}
+
+
+def _load_class(type_name):
+    """Import and return the class named by a dotted path, only importing the module that defines it.
+
+    Paths that do not resolve as-is are looked up relative to the kcontroller package, so both
+    "kcontroller.exchanges.inet_socket.InetSocketExchange" and "exchanges.inet_socket.InetSocketExchange" work.
+    """
+    module_name, _, class_name = type_name.rpartition(".")
+    if not module_name:
+        raise ValueError("invalid type '%s', expected a dotted module path" % type_name)
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError:
+        if module_name.startswith("kcontroller."):
+            raise
+        module = importlib.import_module("kcontroller." + module_name)
+    return getattr(module, class_name)
+
+
+def _get_component_configs(config, plural_key, singular_key):
+    if plural_key in config:
+        return config[plural_key] or []
+    if singular_key in config:
+        return [config[singular_key]]
+    return []
+
+
+def _build_component(component_config, **extra_kwargs):
+    if "type" not in component_config:
+        raise ValueError("component configuration %s is missing a type" % component_config)
+    component_class = _load_class(component_config["type"])
+    args = component_config.get("args", [])
+    kwargs = dict(component_config.get("kwargs", {}))
+    kwargs.update(extra_kwargs)
+    return component_class(*args, **kwargs)
+
+
+def _toggle_profiler(signum, frame):
+    from kcontroller.profiler import profiler
+    if profiler.is_profiling():
+        profiler.stop_profiling()
+        profiler.log_report()
+        logging.info("Collapsed profiler stacks written to %s", profiler.write_collapsed_stacks())
+    else:
+        profiler.start_profiling()
+
+
+def _log_panel_driver_stats(panel_drivers, signum, frame):
+    for panel_driver in panel_drivers:
+        panel_driver.log_stats()
+
+
+def _get_resident_memory_kb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
 def run():
+    start_time = time.time()
+    threading.current_thread().name = "ExchangeLoop"
     _init_logging()
+    # kill -USR1 toggles the sampling profiler
+    signal.signal(signal.SIGUSR1, _toggle_profiler)
+    config = _load_config(sys.argv)
 
-    drivers_to_load = [(TeensyPanelDriver, (), {"vid": 0x16c0, "pid": 0x0488})]
-    # drivers_to_load = [(InetSocketPanelDriver, (('', 1566), ), {})]
-    exchange_to_load = (KerbalTelemachusExchange, ("ws://192.168.1.100:8085/datalink", ), {})
-    # exchange_to_load = (InetSocketExchange, (('', 1565), ), {})
+    driver_configs = _get_component_configs(config, "panel_drivers", "panel_driver")
+    exchange_configs = _get_component_configs(config, "exchanges", "exchange")
+    if not exchange_configs:
+        raise ValueError("no exchange configured")
 
     panel_drivers = []
-    for driver_to_load in drivers_to_load:
-        logging.info("Starting panel driver %s" % driver_to_load[0].__name__)
-        driver = driver_to_load[0](*driver_to_load[1], inbound_queue=PollableQueue(), outbound_queue=PollableQueue(),
-                                   **driver_to_load[2])
+    for driver_config in driver_configs:
+        logging.info("Starting panel driver %s", driver_config.get("type"))
+        driver = _build_component(driver_config, inbound_queue=PollableQueue(), outbound_queue=PollableQueue())
         driver.start()
         panel_drivers.append(driver)
 
-    exchange = exchange_to_load[0](panel_drivers=panel_drivers, *exchange_to_load[1], **exchange_to_load[2])
-    exchange.run()
+    derived_datarefs = None
+    if config.get("derived_datarefs"):
+        from kcontroller.derived import DerivedDatarefEngine
+        derived_datarefs = DerivedDatarefEngine.from_config(config["derived_datarefs"])
+
+    routes = []
+    for exchange_config in exchange_configs:
+        logging.info("Starting exchange %s", exchange_config.get("type"))
+        exchange = _build_component(exchange_config, panel_drivers=panel_drivers, derived_datarefs=derived_datarefs)
+        routes.append(ExchangeRoute(exchange_config.get("name", exchange_config["type"]), exchange,
+                                    exchange_config.get("routes")))
+    router = ExchangeRouter(panel_drivers, routes, derived_datarefs=derived_datarefs)
+    # kill -USR2 logs what the panel drivers filtered and sent so far
+    signal.signal(signal.SIGUSR2, functools.partial(_log_panel_driver_stats, panel_drivers))
+
+    logging.info("Started %s panel driver(s) and %s exchange(s) in %.3fs using %s kB resident memory",
+                 len(panel_drivers), len(exchange_configs), time.time() - start_time, _get_resident_memory_kb())
+    router.run()
 
 
 if __name__ == "__main__":
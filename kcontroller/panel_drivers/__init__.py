@@ -1,17 +1,31 @@
+import itertools
 import logging
 import threading
 import select
-from kcontroller import packets
+import time
+from kcontroller import packets, poll
+from kcontroller.panel_drivers.input_filter import InputFilter
+
+
+_panel_driver_counter = itertools.count(1)
 
 
 class PanelDriver(threading.Thread):
-    def __init__(self, inbound_queue=None, outbound_queue=None):
-        super(PanelDriver, self).__init__()
+    DEFAULT_DEBOUNCE_WINDOW = 0.0
+    DEFAULT_COALESCE_WINDOW = 0.0
+
+    def __init__(self, inbound_queue=None, outbound_queue=None, debounce_window=None, coalesce_window=None,
+                 input_windows=None):
+        super(PanelDriver, self).__init__(name="%s-%s" % (self.__class__.__name__, next(_panel_driver_counter)))
 
         self._inbound_queue = inbound_queue
         self._outbound_queue = outbound_queue
         self._poller = select.poll()
         self._poller.register(self._inbound_queue, select.POLLIN)
+        self._input_filter = InputFilter(
+            debounce_window=debounce_window if debounce_window is not None else self.DEFAULT_DEBOUNCE_WINDOW,
+            coalesce_window=coalesce_window if coalesce_window is not None else self.DEFAULT_COALESCE_WINDOW,
+            input_windows=input_windows)
 
     def get_outbound_queue(self):
         return self._outbound_queue
@@ -19,12 +33,15 @@ class PanelDriver(threading.Thread):
     def get_inbound_queue(self):
         return self._inbound_queue
 
+    def get_input_filter_counters(self):
+        return self._input_filter.get_counters()
+
     def run(self):
         self._init()
         shutdown_requested = False
 
         while not shutdown_requested:
-            ready_list = self._poller.poll()
+            ready_list = poll(self._poller, self._get_poll_timeout())
             if len(ready_list):
                 reduced_ready_list = []
                 for ready in ready_list:
@@ -36,18 +53,32 @@ class PanelDriver(threading.Thread):
                             try:
                                 self._handle_inbound_packet(packet)
                             except Exception as e:
-                                logging.error("unable to handle inbound packet of type %s in %s: %s"
-                                              % (packet.__class__, self.__class__, e.message))
+                                logging.error("unable to handle inbound packet of type %s in %s: %s",
+                                              packet.__class__, self.__class__, e.message)
                     else:
                         reduced_ready_list.append(ready)
                 if len(reduced_ready_list):
                     self._handle_ready(reduced_ready_list)
+            self._handle_timers()
 
-        logging.debug("Shutting down panel driver %s" % self.__class__.__name__)
+        logging.debug("Shutting down panel driver %s", self.__class__.__name__)
+        self.log_stats()
         self._finish()
 
-    def send_packet_to_exchange(self, packet):
-        logging.debug("Sending %s packet to exchange" % packet)
+    def log_stats(self):
+        # also called from the main thread on SIGUSR2, so only read state here
+        counters = self._input_filter.get_counters()
+        logging.info("Panel driver %s forwarded %s input(s), absorbed %s command edge(s) and %s repeated command(s), "
+                     "coalesced %s write(s)", self.name, counters["forwarded"], counters["absorbed_command_edges"],
+                     counters["absorbed_commands_once"], counters["coalesced_writes"])
+
+    def send_packet_to_exchange(self, packet, source=None):
+        # source tells apart the panels of one driver, so their inputs are filtered independently
+        for filtered_packet in self._input_filter.filter(packet, time.time(), source=source):
+            self._put_packet_to_exchange(filtered_packet)
+
+    def _put_packet_to_exchange(self, packet):
+        logging.debug("Sending %s packet to exchange", packet)
         self._outbound_queue.put(packet)
 
     def _init(self):
@@ -59,5 +90,16 @@ class PanelDriver(threading.Thread):
     def _handle_ready(self, ready_list):
         pass
 
+    def _get_poll_timeout(self):
+        # milliseconds until _handle_timers needs to run, None to wait for activity only
+        deadline = self._input_filter.get_next_deadline()
+        if deadline is None:
+            return None
+        return max(0, (deadline - time.time()) * 1000)
+
+    def _handle_timers(self):
+        for packet in self._input_filter.release(time.time()):
+            self._put_packet_to_exchange(packet)
+
     def _handle_inbound_packet(self, packet):
         pass
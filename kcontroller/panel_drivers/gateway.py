@@ -0,0 +1,184 @@
+from collections import OrderedDict
+import errno
+import logging
+import socket
+import select
+import time
+from kcontroller import gateway, packets
+from kcontroller.dataref import Dataref
+from kcontroller.panel_drivers import PanelDriver
+
+
+class _GatewayConnection(object):
+    def __init__(self, connection, address):
+        self.socket = connection
+        self.address = address
+        self.reader = gateway.FrameReader()
+        self.writer = gateway.FrameWriter(connection)
+        self.subscriptions = set()
+        self.pending_entries = []
+        # only the latest value of each dataref is worth sending
+        self.pending_updates = OrderedDict()
+
+    def has_pending(self):
+        return len(self.pending_entries) or len(self.pending_updates)
+
+    def flush(self):
+        """Queue the pending entries as one frame and write what the socket accepts, True once all is written."""
+        if self.has_pending():
+            entries = self.pending_entries
+            entries.extend([gateway.ENTRY_UPDATE, name, value] for name, value in self.pending_updates.iteritems())
+            self.pending_entries = []
+            self.pending_updates = OrderedDict()
+            self.writer.write(entries)
+        return self.writer.flush()
+
+    def __str__(self):
+        return "%s:%s" % self.address
+
+
+class GatewayPanelDriver(PanelDriver):
+    """Serves remote kcontroller gateways, each multiplexing the panels of one node over a single connection.
+
+    Updates are only sent to the gateways that subscribed to them and are batched for batch_interval
+    seconds into a single frame. A reconnecting gateway resubscribes and gets the latest values back.
+    """
+
+    def __init__(self, bind_address, batch_interval=0.01, *args, **kwargs):
+        super(GatewayPanelDriver, self).__init__(*args, **kwargs)
+        self._bind_address = tuple(bind_address)
+        self._batch_interval = batch_interval
+        self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._connections = {}
+        self._last_values = {}
+        self._sim_running = False
+        self._next_flush = None
+
+    def _init(self):
+        self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server_socket.bind(self._bind_address)
+        self._server_socket.listen(5)
+        self._poller.register(self._server_socket, select.POLLIN)
+        logging.debug("Gateway panel driver listening on port %s", self._bind_address[1])
+
+    def _finish(self):
+        for connection in self._connections.values():
+            connection.socket.close()
+        self._connections = {}
+        self._server_socket.close()
+
+    def _get_poll_timeout(self):
+        input_timeout = super(GatewayPanelDriver, self)._get_poll_timeout()
+        if self._next_flush is None:
+            return input_timeout
+        timeout = max(0, (self._next_flush - time.time()) * 1000)
+        return timeout if input_timeout is None else min(timeout, input_timeout)
+
+    def _handle_timers(self):
+        super(GatewayPanelDriver, self)._handle_timers()
+        if self._next_flush is not None and time.time() >= self._next_flush:
+            self._next_flush = None
+            for connection in self._connections.values():
+                if connection.has_pending():
+                    self._flush_connection(connection)
+
+    def _flush_connection(self, connection):
+        try:
+            flushed = connection.flush()
+        except (IOError, socket.error) as e:
+            logging.warning("Gateway %s send failed: %s", connection, e)
+            self._close_connection(connection)
+            return
+        # a slow gateway is written to as its socket drains, without holding up the others
+        self._poller.modify(connection.socket, select.POLLIN if flushed else select.POLLIN | select.POLLOUT)
+
+    def _schedule_flush(self):
+        if self._next_flush is None:
+            self._next_flush = time.time() + self._batch_interval
+
+    def _handle_ready(self, ready_list):
+        for ready in ready_list:
+            if ready[0] == self._server_socket.fileno():
+                connection_socket, address = self._server_socket.accept()
+                connection_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                connection_socket.setblocking(0)
+                connection = _GatewayConnection(connection_socket, address)
+                self._connections[connection_socket.fileno()] = connection
+                self._poller.register(connection_socket, select.POLLIN)
+                logging.info("Gateway connected from %s", connection)
+                if self._sim_running:
+                    connection.pending_entries.append([gateway.ENTRY_SIMULATION, True])
+                    self._schedule_flush()
+            elif ready[0] in self._connections:
+                connection = self._connections[ready[0]]
+                if ready[1] & select.POLLOUT:
+                    self._flush_connection(connection)
+                    if ready[0] not in self._connections or not ready[1] & (select.POLLIN | select.POLLHUP):
+                        continue
+                try:
+                    data = connection.socket.recv(65536) if not ready[1] & select.POLLHUP else ""
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        continue
+                    logging.warning("Gateway %s receive failed: %s", connection, e)
+                    data = ""
+                if not data:
+                    self._close_connection(connection)
+                    continue
+                connection.reader.feed(data)
+                try:
+                    for entry in connection.reader.read_entries():
+                        self._handle_entry(connection, entry)
+                except Exception as e:
+                    logging.warning("Gateway %s sent an invalid frame: %s", connection, e)
+                    self._close_connection(connection)
+
+    def _close_connection(self, connection):
+        logging.info("Gateway %s disconnected", connection)
+        self._poller.unregister(connection.socket)
+        del self._connections[connection.socket.fileno()]
+        connection.socket.close()
+
+    def _handle_entry(self, connection, entry):
+        kind = entry[0]
+        if kind == gateway.ENTRY_SUBSCRIBE:
+            name, data_type = entry[1:3]
+            connection.subscriptions.add(name)
+            Dataref.register(name, data_type)
+            self.send_packet_to_exchange(packets.DataSubscribeRequest(Dataref.factory(name, None)))
+            # bring a (re)connecting gateway up to date
+            if name in self._last_values:
+                connection.pending_updates[name] = self._last_values[name]
+            self._schedule_flush()
+        elif kind == gateway.ENTRY_WRITE:
+            name, value = entry[1:3]
+            self.send_packet_to_exchange(packets.DataWrite(Dataref.factory(name, value)), source=str(connection))
+        elif kind == gateway.ENTRY_COMMAND:
+            name, action = entry[1:3]
+            if action == "begin":
+                packet = packets.CommandBegin(Dataref.factory(name, Dataref.COMMAND_BEGIN))
+            elif action == "end":
+                packet = packets.CommandEnd(Dataref.factory(name, Dataref.COMMAND_END))
+            elif action == "once":
+                packet = packets.CommandOnce(Dataref.factory(name, Dataref.COMMAND_ONCE))
+            else:
+                raise NotImplementedError("unsupported command action: %s" % action)
+            self.send_packet_to_exchange(packet, source=str(connection))
+        else:
+            raise NotImplementedError("unsupported gateway entry: %s" % kind)
+
+    def _handle_inbound_packet(self, packet):
+        logging.debug("Gateway panel driver received packet %s", packet)
+        if isinstance(packet, (packets.SimulationStart, packets.SimulationStop)):
+            self._sim_running = isinstance(packet, packets.SimulationStart)
+            for connection in self._connections.values():
+                connection.pending_entries.append([gateway.ENTRY_SIMULATION, self._sim_running])
+        elif isinstance(packet, packets.DataWrite):
+            dataref = packet.get_dataref()
+            self._last_values[dataref.get_name()] = dataref.get_value()
+            for connection in self._connections.values():
+                if dataref.get_name() in connection.subscriptions:
+                    connection.pending_updates[dataref.get_name()] = dataref.get_value()
+        else:
+            raise NotImplementedError("%s does not implement packet type %s" % (self.__class__, packet.__class__))
+        self._schedule_flush()
@@ -0,0 +1,156 @@
+import errno
+import logging
+import os
+import select
+import socket
+from kcontroller import poll
+
+SYSFS_HIDRAW_PATH = "/sys/class/hidraw"
+NETLINK_KOBJECT_UEVENT = 15
+
+
+class HidrawDeviceInfo(object):
+    def __init__(self, name, vid, pid, usage=None, usage_page=None, phys=None, uniq=None):
+        self.name = name
+        self.path = os.path.join("/dev", name)
+        self.vid = vid
+        self.pid = pid
+        self.usage = usage
+        self.usage_page = usage_page
+        self.phys = phys
+        self.uniq = uniq
+
+    def get_identity(self):
+        # the serial number survives a replug on another port, the physical path is the next best thing
+        return self.uniq if self.uniq else self.phys
+
+    def __str__(self):
+        return "<%s %s %04x:%04x %s>" % (self.__class__.__name__, self.name, self.vid, self.pid, self.get_identity())
+
+
+class HidrawDevice(object):
+    REPORT_SIZE = 64
+
+    def __init__(self, path):
+        self._path = path
+        self._fd = None
+
+    def open(self):
+        self._fd = os.open(self._path, os.O_RDWR)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def fileno(self):
+        return self._fd
+
+    def recv(self, size, timeout):
+        if not self._wait(select.POLLIN, timeout):
+            return ""
+        return os.read(self._fd, size)
+
+    def send(self, data, timeout):
+        if not self._wait(select.POLLOUT, timeout):
+            raise IOError(errno.ETIMEDOUT, "timed out writing to %s" % self._path)
+        # unnumbered reports are prefixed with a zero report id and sent as a full report
+        return os.write(self._fd, "\x00" + data[:self.REPORT_SIZE].ljust(self.REPORT_SIZE, "\x00"))
+
+    def check_connected(self, timeout):
+        # errors and hangups are reported whatever the event mask, so this only returns early on a disconnect
+        self._wait(0, timeout)
+
+    def _wait(self, event_mask, timeout):
+        poller = select.poll()
+        poller.register(self._fd, event_mask)
+        ready_list = poll(poller, timeout)
+        if not len(ready_list):
+            return False
+        if ready_list[0][1] & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+            raise IOError(errno.ENODEV, "device %s disconnected" % self._path)
+        return True
+
+
+class UeventMonitor(object):
+    """Pollable kernel uevent listener reporting hidraw devices being added or removed."""
+
+    def __init__(self):
+        self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        self._socket.bind((0, 1))
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def close(self):
+        self._socket.close()
+
+    def recv(self):
+        fields = self._socket.recv(8192).split("\x00")
+        event = dict(field.split("=", 1) for field in fields[1:] if "=" in field)
+        if event.get("SUBSYSTEM") != "hidraw":
+            return None
+        return event
+
+
+def find_devices(vid, pid, usage=None, usage_page=None):
+    found_devices = []
+    try:
+        names = sorted(os.listdir(SYSFS_HIDRAW_PATH))
+    except OSError as e:
+        logging.warning("unable to list hidraw devices: %s", e.strerror)
+        return found_devices
+
+    for name in names:
+        try:
+            device_info = _read_device_info(name)
+        except (IOError, OSError, ValueError) as e:
+            # devices can disappear while we are looking at them
+            logging.debug("skipping hidraw device %s: %s", name, e)
+            continue
+        if device_info.vid != vid or device_info.pid != pid:
+            continue
+        if usage is not None and device_info.usage != usage:
+            continue
+        if usage_page is not None and device_info.usage_page != usage_page:
+            continue
+        found_devices.append(device_info)
+    return found_devices
+
+
+def _read_device_info(name):
+    device_path = os.path.join(SYSFS_HIDRAW_PATH, name, "device")
+    with open(os.path.join(device_path, "uevent")) as f:
+        uevent = dict(line.strip().split("=", 1) for line in f if "=" in line)
+    _, vid, pid = uevent["HID_ID"].split(":")
+    with open(os.path.join(device_path, "report_descriptor"), "rb") as f:
+        usage_page, usage = _parse_top_level_usage(f.read())
+    return HidrawDeviceInfo(name, int(vid, 16), int(pid, 16), usage=usage, usage_page=usage_page,
+                            phys=uevent.get("HID_PHYS"), uniq=uevent.get("HID_UNIQ"))
+
+
+def _parse_top_level_usage(descriptor):
+    usage_page = None
+    usage = None
+    position = 0
+    while position < len(descriptor):
+        prefix = ord(descriptor[position])
+        if prefix == 0xfe:
+            # long item, never used for usages
+            position += 3 + ord(descriptor[position + 1])
+            continue
+        size = (0, 1, 2, 4)[prefix & 0x03]
+        item_type = (prefix >> 2) & 0x03
+        tag = prefix >> 4
+        value = 0
+        for index, byte in enumerate(descriptor[position + 1:position + 1 + size]):
+            value |= ord(byte) << (8 * index)
+        position += 1 + size
+
+        if item_type == 1 and tag == 0x0 and usage_page is None:
+            usage_page = value
+        elif item_type == 2 and tag == 0x0 and usage is None:
+            usage = value & 0xffff
+        elif item_type == 0 and tag == 0xa:
+            break
+    return usage_page, usage
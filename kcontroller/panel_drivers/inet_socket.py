@@ -9,7 +9,7 @@ from kcontroller.panel_drivers import PanelDriver
 class InetSocketPanelDriver(PanelDriver):
     def __init__(self, bind_address, *args, **kwargs):
         super(InetSocketPanelDriver, self).__init__(*args, **kwargs)
-        self._bind_address = bind_address
+        self._bind_address = tuple(bind_address)
         self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._connections = []
 
@@ -18,7 +18,7 @@ class InetSocketPanelDriver(PanelDriver):
         self._server_socket.bind(self._bind_address)
         self._server_socket.listen(5)
         self._poller.register(self._server_socket, select.POLLIN)
-        logging.debug("Socket panel driver listening on port %s" % self._bind_address[1])
+        logging.debug("Socket panel driver listening on port %s", self._bind_address[1])
 
     def _finish(self):
         for connection in self._connections:
@@ -32,29 +32,29 @@ class InetSocketPanelDriver(PanelDriver):
                 connection = self._server_socket.accept()
                 self._connections.append(connection)
                 self._poller.register(connection[0], select.POLLIN)
-                logging.debug("Socket panel driver received new connection from %s:%s"
-                              % (connection[1][0], connection[1][1]))
+                logging.debug("Socket panel driver received new connection from %s:%s",
+                              connection[1][0], connection[1][1])
             else:
                 for connection in self._connections:
                     if ready[0] == connection[0].fileno():
                         if ready[1] & select.POLLHUP:
                             self._poller.unregister(connection[0])
                             connection[0].close()
-                            logging.debug("Socket panel driver connection %s:%s hung up"
-                                          % (connection[1][0], connection[1][1]))
+                            logging.debug("Socket panel driver connection %s:%s hung up",
+                                          connection[1][0], connection[1][1])
                             self._connections.remove(connection)
                         else:
                             payload = connection[0].recv(4096)
-                            logging.debug("Socket panel driver connection %s:%s received %s byte(s)"
-                                          % (connection[1][0], connection[1][1], len(payload)))
+                            logging.debug("Socket panel driver connection %s:%s received %s byte(s)",
+                                          connection[1][0], connection[1][1], len(payload))
                             try:
-                                self._parse_payload(payload.strip())
+                                self._parse_payload(payload.strip(), source="%s:%s" % connection[1])
                             except Exception as e:
-                                logging.warning("Socket panel driver connection %s:%s error: %s"
-                                                % (connection[1][0], connection[1][1], e.message))
+                                logging.warning("Socket panel driver connection %s:%s error: %s",
+                                                connection[1][0], connection[1][1], e.message)
 
     def _handle_inbound_packet(self, packet):
-        logging.debug("Socket panel driver received packet %s" % packet)
+        logging.debug("Socket panel driver received packet %s", packet)
         if isinstance(packet, packets.SimulationStart):
             payload = "simulation start"
         elif isinstance(packet, packets.SimulationStop):
@@ -67,7 +67,8 @@ class InetSocketPanelDriver(PanelDriver):
         for connection in self._connections:
             connection[0].sendall(payload + "\n")
 
-    def _parse_payload(self, payload):
+    def _parse_payload(self, payload, source=None):
+        # source is the address of the connection, so the inputs of each board are filtered independently
         if payload.startswith("register "):
             name, data_type = payload[9:].split(" ")
             if data_type == "integer" or data_type == "int":
@@ -93,9 +94,9 @@ class InetSocketPanelDriver(PanelDriver):
                 packet = packets.CommandOnce(dataref)
             else:
                 raise NotImplementedError("unsupported command action: %s" % action)
-            self.send_packet_to_exchange(packet)
+            self.send_packet_to_exchange(packet, source=source)
         elif payload.startswith("write "):
             name, value = payload[6:].split(" ")
             dataref = Dataref.factory(name, value)
             packet = packets.DataWrite(dataref)
-            self.send_packet_to_exchange(packet)
+            self.send_packet_to_exchange(packet, source=source)
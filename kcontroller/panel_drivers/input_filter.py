@@ -0,0 +1,113 @@
+from kcontroller import packets
+
+
+class InputFilter(object):
+    """Debounces command edges and coalesces write bursts coming from a panel before they reach the exchange.
+
+    Begin/end edges of a command are held until no other edge was seen for the debounce window and only
+    forwarded when the settled state differs from the last forwarded one. Repeated once commands within
+    the window are dropped. Writes to a dataref are forwarded at most once per coalesce window, carrying
+    the latest value. Windows can be overridden per dataref name through input_windows.
+
+    Every command starts out ended, so a press and release shorter than the debounce window is absorbed
+    as a pair. State is kept per source, so the same command used on two panels is filtered separately.
+    """
+
+    def __init__(self, debounce_window=0.0, coalesce_window=0.0, input_windows=None):
+        self._debounce_window = debounce_window
+        self._coalesce_window = coalesce_window
+        self._input_windows = input_windows if input_windows else {}
+
+        self._pending_commands = {}
+        self._command_states = {}
+        self._last_command_once_times = {}
+        self._pending_writes = {}
+        self._last_write_times = {}
+
+        self._counters = {
+            "forwarded": 0,
+            "absorbed_command_edges": 0,
+            "absorbed_commands_once": 0,
+            "coalesced_writes": 0,
+        }
+
+    def get_counters(self):
+        return dict(self._counters)
+
+    def filter(self, packet, now, source=None):
+        """Return the packets that can be forwarded right away, holding back the others until release."""
+        if isinstance(packet, (packets.CommandBegin, packets.CommandEnd)):
+            forwarded = self._filter_command_edge(packet, now, source)
+        elif isinstance(packet, packets.CommandOnce):
+            forwarded = self._filter_command_once(packet, now, source)
+        elif isinstance(packet, packets.DataWrite):
+            forwarded = self._filter_write(packet, now, source)
+        else:
+            forwarded = [packet]
+        self._counters["forwarded"] += len(forwarded)
+        return forwarded
+
+    def release(self, now):
+        """Return the held packets whose window has elapsed."""
+        released = []
+        for key, (packet, deadline) in self._pending_commands.items():
+            if deadline <= now:
+                del self._pending_commands[key]
+                if self._command_states.get(key, packets.CommandEnd) is packet.__class__:
+                    self._counters["absorbed_command_edges"] += 1
+                else:
+                    self._command_states[key] = packet.__class__
+                    released.append(packet)
+        for key, (packet, deadline) in self._pending_writes.items():
+            if deadline <= now:
+                del self._pending_writes[key]
+                self._last_write_times[key] = now
+                released.append(packet)
+        self._counters["forwarded"] += len(released)
+        return released
+
+    def get_next_deadline(self):
+        deadlines = [pending[1] for pending in self._pending_commands.values()]
+        deadlines.extend(pending[1] for pending in self._pending_writes.values())
+        return min(deadlines) if deadlines else None
+
+    def _get_window(self, name, default_window):
+        return self._input_windows.get(name, default_window)
+
+    def _filter_command_edge(self, packet, now, source):
+        name = packet.get_command().get_name()
+        key = (source, name)
+        window = self._get_window(name, self._debounce_window)
+        if window <= 0:
+            self._command_states[key] = packet.__class__
+            return [packet]
+        if key in self._pending_commands:
+            self._counters["absorbed_command_edges"] += 1
+        self._pending_commands[key] = (packet, now + window)
+        return []
+
+    def _filter_command_once(self, packet, now, source):
+        name = packet.get_command().get_name()
+        key = (source, name)
+        window = self._get_window(name, self._debounce_window)
+        last_time = self._last_command_once_times.get(key)
+        if window > 0 and last_time is not None and now - last_time < window:
+            self._counters["absorbed_commands_once"] += 1
+            return []
+        self._last_command_once_times[key] = now
+        return [packet]
+
+    def _filter_write(self, packet, now, source):
+        name = packet.get_dataref().get_name()
+        key = (source, name)
+        window = self._get_window(name, self._coalesce_window)
+        if key in self._pending_writes:
+            self._counters["coalesced_writes"] += 1
+            self._pending_writes[key] = (packet, self._pending_writes[key][1])
+            return []
+        last_time = self._last_write_times.get(key)
+        if window <= 0 or last_time is None or now - last_time >= window:
+            self._last_write_times[key] = now
+            return [packet]
+        self._pending_writes[key] = (packet, last_time + window)
+        return []
@@ -1,134 +1,329 @@
 import logging
+import os
 import socket
 import struct
 import threading
-import TeensyRawhid
 import select
 import time
 from kcontroller import packets, PollableQueue
 from kcontroller.dataref import Dataref, DatarefInteger, DatarefFloat
 from kcontroller.panel_drivers import PanelDriver
+from kcontroller.panel_drivers import hidraw
+from kcontroller.panel_drivers.update_scheduler import UpdateScheduler
 
 
 class TeensyWrapper(threading.Thread):
-    def __init__(self, shutdown_flag, sim_running_flag, vid=0x16c0, pid=0x0488, usage=0xa739, usage_page=0xff1c):
-        super(TeensyWrapper, self).__init__()
-        self._shutdown_flag = shutdown_flag
+    KEEPALIVE_PAYLOAD = "\x04\x03\x02\x00"
+
+    def __init__(self, device_info, sim_running_flag, registration_map=None, update_scheduler=None):
+        super(TeensyWrapper, self).__init__(name="TeensyWrapper-%s" % device_info.name)
+        self._device_info = device_info
+        self._shutdown_flag = threading.Event()
         self._sim_running_flag = sim_running_flag
-        self._vid = vid
-        self._pid = pid
-        self._usage = usage
-        self._usage_page = usage_page
+        self._update_scheduler = update_scheduler if update_scheduler else UpdateScheduler()
+        self._open_error = None
 
+        self.registration_map = registration_map if registration_map is not None else {}
         self.outbound_queue = PollableQueue()
         self.inbound_queue = PollableQueue()
 
-        self._put_socket, self._get_socket = socket.socketpair()
-        self._lock = threading.Lock()
+    def get_device_info(self):
+        return self._device_info
 
-    def run(self):
-        logging.debug("Attempting to open device %s:%s" % (self._vid, self._pid))
-        teensy = TeensyRawhid.Rawhid()
-        teensy.open(vid=self._vid, pid=self._pid, usage=self._usage, usage_page=self._usage_page)
+    def get_update_scheduler(self):
+        return self._update_scheduler
+
+    def get_open_error(self):
+        return self._open_error
+
+    def stop(self):
+        self._shutdown_flag.set()
 
+    def run(self):
+        logging.debug("Attempting to open device %s", self._device_info)
+        teensy = hidraw.HidrawDevice(self._device_info.path)
+        try:
+            teensy.open()
+        except (IOError, OSError) as e:
+            logging.debug("Unable to open device %s: %s", self._device_info, e.strerror)
+            self._open_error = e.strerror
+            self.outbound_queue.put(None)
+            return
+
+        try:
+            self._run_device(teensy)
+        except (IOError, OSError) as e:
+            logging.warning("Lost device %s: %s", self._device_info, e.strerror)
+        finally:
+            logging.debug("Closing device %s", self._device_info)
+            teensy.close()
+
+        if not self._shutdown_flag.is_set():
+            # an empty payload tells the panel driver this device went away
+            self.outbound_queue.put(None)
+
+    def _run_device(self, teensy):
         last_keepalive = None
-        poller = select.poll()
-        poller.register(self.inbound_queue, select.POLLIN)
 
         while not self._shutdown_flag.is_set():
             if self._sim_running_flag.is_set():
-                try:
-                    payload = teensy.recv(64, 20)
-                    logging.debug("received payload of %s byte(s) from teensy" % len(payload))
+                payload = teensy.recv(64, self._get_recv_timeout())
+                if payload:
+                    logging.debug("received payload of %s byte(s) from teensy", len(payload))
                     self.outbound_queue.put(payload)
-                except IOError as e:
-                    if e.errno is not None:
-                        raise e
-
-                ready_list = poller.poll(0.001)
-                if len(ready_list):
-                    payload = self.inbound_queue.get()
-                    logging.debug("Teensy panel driver %s sending %s byte(s)"
-                                  % (self.outbound_queue.fileno(), len(payload)))
-                    teensy.send(payload, 100)
 
                 now = time.time()
+                self._schedule_inbound_payloads(now)
                 if not last_keepalive or (now - last_keepalive) > 0.5:
-                    teensy.send("\x04\x03\x02\x00", 100)
+                    self._update_scheduler.add_control(TeensyWrapper.KEEPALIVE_PAYLOAD)
                     last_keepalive = now
-            else:
-                time.sleep(0.1)
 
-        logging.debug("Closing device %s:%s" % (self._vid, self._pid))
-        teensy.close()
+                report = self._update_scheduler.next_report(now)
+                if report:
+                    logging.debug("Teensy panel driver %s sending %s byte(s)",
+                                  self.outbound_queue.fileno(), len(report))
+                    teensy.send(report, 100)
+            else:
+                # still notice an unplug while the simulation is stopped
+                teensy.check_connected(100)
+
+    def _get_recv_timeout(self):
+        # wake up in time for the next report the scheduler can send
+        deadline = self._update_scheduler.get_next_deadline()
+        if deadline is None:
+            return 20
+        return min(20, max(0, (deadline - time.time()) * 1000))
+
+    def _schedule_inbound_payloads(self, now):
+        while not self.inbound_queue.empty():
+            payload = self.inbound_queue.get()
+            if ord(payload[1]) == 0x02:
+                registration_id = struct.unpack("<H", payload[2:4])[0]
+                name = self.registration_map.get(registration_id, registration_id)
+                self._update_scheduler.add_update(name, payload, now)
+            else:
+                self._update_scheduler.add_control(payload)
 
 
 class TeensyPanelDriver(PanelDriver):
-    def __init__(self, vid=0x16c0, pid=0x0488, usage=0xa739, usage_page=0xff1c, *args, **kwargs):
+    SIMULATION_START_PAYLOAD = "\x04\x03\x01\x00"
+    SIMULATION_STOP_PAYLOAD = "\x04\x03\x03\x00"
+    # mechanical switches bounce for a few milliseconds, encoders and potentiometers send bursts of writes
+    DEFAULT_DEBOUNCE_WINDOW = 0.01
+    DEFAULT_COALESCE_WINDOW = 0.02
+
+    def __init__(self, vid=0x16c0, pid=0x0488, usage=0xa739, usage_page=0xff1c, rescan_interval=1.0,
+                 reports_per_second=100.0, update_priorities=None, max_refresh_rates=None, pack_reports=False,
+                 *args, **kwargs):
         super(TeensyPanelDriver, self).__init__(*args, **kwargs)
-        self._shutdown_flag = threading.Event()
+        self._vid = vid
+        self._pid = pid
+        self._usage = usage
+        self._usage_page = usage_page
+        self._rescan_interval = rescan_interval
+        self._reports_per_second = reports_per_second
+        self._update_priorities = update_priorities
+        self._max_refresh_rates = max_refresh_rates
+        self._pack_reports = pack_reports
+        self._next_rescan = None
+        self._uevent_monitor = None
         self._sim_running_flag = threading.Event()
-        self._registration_map = {}
-        self._teensy_wrapper = TeensyWrapper(self._shutdown_flag, self._sim_running_flag, vid=vid, pid=pid, usage=usage,
-                                             usage_page=usage_page)
+        self._teensy_wrappers = {}
+        # registration maps outlive their panel so a replugged panel comes back with them
+        self._registration_maps = {}
+        self._last_datarefs = {}
+        # consecutive open failures and next attempt time, by device path
+        self._open_failures = {}
+
+    def get_update_stats(self):
+        """Return the report count and per dataref update stats of each connected panel, by device path.
+
+        Safe to call from other threads while the panels run.
+        """
+        now = time.time()
+        stats = {}
+        for teensy_wrapper in self._teensy_wrappers.values():
+            update_scheduler = teensy_wrapper.get_update_scheduler()
+            stats[teensy_wrapper.get_device_info().path] = {
+                "reports": update_scheduler.get_report_count(),
+                "datarefs": update_scheduler.get_stats(now),
+            }
+        return stats
+
+    def log_stats(self):
+        super(TeensyPanelDriver, self).log_stats()
+        for teensy_wrapper in self._teensy_wrappers.values():
+            self._log_update_stats(teensy_wrapper)
 
     def _init(self):
-        self._registration_map = {}
-        logging.debug("Starting teensy panel")
-        self._teensy_wrapper.start()
-        self._poller.register(self._teensy_wrapper.outbound_queue, select.POLLIN)
+        logging.debug("Starting teensy panel driver for %04x:%04x", self._vid, self._pid)
+        try:
+            self._uevent_monitor = hidraw.UeventMonitor()
+            self._poller.register(self._uevent_monitor, select.POLLIN)
+        except socket.error as e:
+            logging.warning("Teensy hotplug notifications unavailable (%s), rescanning every %ss",
+                            e, self._rescan_interval)
+            self._uevent_monitor = None
+        self._rescan_devices()
 
     def _finish(self):
-        self._poller.unregister(self._teensy_wrapper.outbound_queue)
-        logging.debug("Shutting down teensy panel")
-        self._shutdown_flag.set()
-        self._teensy_wrapper.join()
+        logging.debug("Shutting down teensy panels")
+        if self._uevent_monitor:
+            self._poller.unregister(self._uevent_monitor)
+            self._uevent_monitor.close()
+        for teensy_wrapper in self._teensy_wrappers.values():
+            self._poller.unregister(teensy_wrapper.outbound_queue)
+            teensy_wrapper.stop()
+        # run() logged their update stats already
+        for teensy_wrapper in self._teensy_wrappers.values():
+            teensy_wrapper.join()
+        self._teensy_wrappers = {}
+
+    def _get_poll_timeout(self):
+        timeout = max(0, (self._next_rescan - time.time()) * 1000)
+        input_timeout = super(TeensyPanelDriver, self)._get_poll_timeout()
+        return timeout if input_timeout is None else min(timeout, input_timeout)
+
+    def _handle_timers(self):
+        super(TeensyPanelDriver, self)._handle_timers()
+        if time.time() >= self._next_rescan:
+            self._rescan_devices()
+
+    def _rescan_devices(self):
+        now = time.time()
+        self._next_rescan = now + self._rescan_interval
+        connected_paths = [teensy_wrapper.get_device_info().path for teensy_wrapper in self._teensy_wrappers.values()]
+        for device_info in hidraw.find_devices(self._vid, self._pid, usage=self._usage, usage_page=self._usage_page):
+            if device_info.path in connected_paths:
+                continue
+            if device_info.path in self._open_failures and now < self._open_failures[device_info.path][1]:
+                continue
+            self._add_panel(device_info)
+
+    def _add_panel(self, device_info):
+        registration_map = self._registration_maps.setdefault(device_info.get_identity(), {})
+        update_scheduler = UpdateScheduler(report_size=hidraw.HidrawDevice.REPORT_SIZE,
+                                           reports_per_second=self._reports_per_second,
+                                           priorities=self._update_priorities,
+                                           max_refresh_rates=self._max_refresh_rates,
+                                           pack_reports=self._pack_reports)
+        teensy_wrapper = TeensyWrapper(device_info, self._sim_running_flag, registration_map=registration_map,
+                                       update_scheduler=update_scheduler)
+        self._teensy_wrappers[teensy_wrapper.outbound_queue.fileno()] = teensy_wrapper
+        self._poller.register(teensy_wrapper.outbound_queue, select.POLLIN)
+        teensy_wrapper.start()
+        logging.info("Starting panel %s on %s with %s known registration(s)",
+                     teensy_wrapper.outbound_queue.fileno(), device_info, len(registration_map))
+
+        if self._sim_running_flag.is_set():
+            teensy_wrapper.inbound_queue.put(TeensyPanelDriver.SIMULATION_START_PAYLOAD)
+        for name in registration_map.values():
+            self._restore_last_value(teensy_wrapper, name)
+
+    def _remove_panel(self, teensy_wrapper):
+        self._poller.unregister(teensy_wrapper.outbound_queue)
+        del self._teensy_wrappers[teensy_wrapper.outbound_queue.fileno()]
+        teensy_wrapper.join()
+        device_info = teensy_wrapper.get_device_info()
+        if teensy_wrapper.get_open_error():
+            failures = self._open_failures.get(device_info.path, (0, None))[0] + 1
+            retry_interval = min(self._rescan_interval * 2 ** failures, 60.0)
+            self._open_failures[device_info.path] = (failures, time.time() + retry_interval)
+            # only the first failure in a row is worth a warning, the device may never become accessible
+            logging.log(logging.WARNING if failures == 1 else logging.DEBUG, "Unable to open panel on %s: %s, "
+                        "retrying in %ss", device_info, teensy_wrapper.get_open_error(), retry_interval)
+            return
+        self._open_failures.pop(device_info.path, None)
+        logging.info("Panel %s on %s went away", teensy_wrapper.outbound_queue.fileno(), device_info)
+        self._log_update_stats(teensy_wrapper)
+
+    def _handle_uevent(self, event):
+        logging.debug("Received hidraw %s event for %s", event.get("ACTION"), event.get("DEVNAME"))
+        name = event.get("DEVNAME", "").split("/")[-1]
+        if event.get("ACTION") == "remove":
+            for teensy_wrapper in self._teensy_wrappers.values():
+                if teensy_wrapper.get_device_info().name == name:
+                    teensy_wrapper.stop()
+                    self._remove_panel(teensy_wrapper)
+        else:
+            # a new device, or a changed one such as after fixing its permissions, gets a fresh attempt
+            self._open_failures.pop(os.path.join("/dev", name), None)
+            self._rescan_devices()
+
+    @staticmethod
+    def _log_update_stats(teensy_wrapper):
+        update_scheduler = teensy_wrapper.get_update_scheduler()
+        logging.info("Panel on %s was sent %s report(s)", teensy_wrapper.get_device_info(),
+                     update_scheduler.get_report_count())
+        for name, stats in sorted(update_scheduler.get_stats(time.time()).iteritems()):
+            logging.info("Panel on %s dataref %s: %s update(s) at %.1f/s, %s superseded, max staleness %.3fs",
+                         teensy_wrapper.get_device_info(), name, stats["sent"], stats["refresh_rate"],
+                         stats["superseded"], stats["max_staleness"])
+
+    def _restore_last_value(self, teensy_wrapper, name):
+        if name in self._last_datarefs:
+            self._send_dataref_to_panel(teensy_wrapper, self._last_datarefs[name])
 
     def _handle_ready(self, ready_list):
         for ready in ready_list:
-            if ready[0] == self._teensy_wrapper.outbound_queue.fileno():
-                data = self._teensy_wrapper.outbound_queue.get()
-                logging.debug("Teensy panel driver %s received %s byte(s)"
-                              % (self._teensy_wrapper.outbound_queue.fileno(), len(data)))
+            if self._uevent_monitor and ready[0] == self._uevent_monitor.fileno():
+                event = self._uevent_monitor.recv()
+                if event:
+                    self._handle_uevent(event)
+            elif ready[0] in self._teensy_wrappers:
+                teensy_wrapper = self._teensy_wrappers[ready[0]]
+                data = teensy_wrapper.outbound_queue.get()
+                if data is None:
+                    self._remove_panel(teensy_wrapper)
+                    continue
+                logging.debug("Teensy panel driver %s received %s byte(s)", ready[0], len(data))
                 try:
                     received_payloads = TeensyPanelDriver._extract_payloads_from_buffer(data)
                     for payload in received_payloads:
-                        logging.debug("Panel %s sent valid %s byte(s) packet!"
-                                      % (self._teensy_wrapper.outbound_queue.fileno(), len(payload)))
-                        self._parse_payload(payload)
+                        logging.debug("Panel %s sent valid %s byte(s) packet!", ready[0], len(payload))
+                        self._parse_payload(teensy_wrapper, payload)
                 except Exception as e:
-                    logging.warning("Teensy panel driver %s error: %s"
-                                    % (self._teensy_wrapper.outbound_queue.fileno(), e.message))
+                    logging.warning("Teensy panel driver %s error: %s", ready[0], e.message)
 
     def _handle_inbound_packet(self, packet):
-        logging.debug("Teensy panel driver %s received packet %s"
-                      % (self._teensy_wrapper.outbound_queue.fileno(), packet))
+        logging.debug("Teensy panel driver received packet %s", packet)
         if isinstance(packet, packets.SimulationStart):
-            payload = "\x04\x03\x01\x00"
             self._sim_running_flag.set()
+            self._send_payload_to_panels(TeensyPanelDriver.SIMULATION_START_PAYLOAD)
         elif isinstance(packet, packets.SimulationStop):
-            payload = "\x04\x03\x03\x00"
             self._sim_running_flag.clear()
+            self._send_payload_to_panels(TeensyPanelDriver.SIMULATION_STOP_PAYLOAD)
         elif isinstance(packet, packets.DataWrite):
-            payload = self._build_data_write_payload(packet.get_dataref())
+            dataref = packet.get_dataref()
+            self._last_datarefs[dataref.get_name()] = dataref
+            for teensy_wrapper in self._teensy_wrappers.values():
+                self._send_dataref_to_panel(teensy_wrapper, dataref)
         else:
             raise NotImplementedError("%s does not implement packet type %s" % (self.__class__, packet.__class__))
-        self._teensy_wrapper.inbound_queue.put(payload)
 
-    def _parse_payload(self, payload):
+    def _send_payload_to_panels(self, payload):
+        for teensy_wrapper in self._teensy_wrappers.values():
+            teensy_wrapper.inbound_queue.put(payload)
+
+    def _send_dataref_to_panel(self, teensy_wrapper, dataref):
+        registration_id = TeensyPanelDriver._find_registration_id(teensy_wrapper.registration_map, dataref.get_name())
+        if registration_id is not None:
+            teensy_wrapper.inbound_queue.put(self._build_data_write_payload(registration_id, dataref))
+
+    def _parse_payload(self, teensy_wrapper, payload):
         packet_type = ord(payload[1])
         if packet_type == 0x01:
-            self._parse_register_payload(payload)
+            self._parse_register_payload(teensy_wrapper, payload)
         elif packet_type == 0x02:
-            self._parse_write_payload(payload)
+            self._parse_write_payload(teensy_wrapper, payload)
         elif packet_type == 0x04:
-            self._parse_command_begin_payload(payload)
+            self._parse_command_begin_payload(teensy_wrapper, payload)
         elif packet_type == 0x05:
-            self._parse_command_end_payload(payload)
+            self._parse_command_end_payload(teensy_wrapper, payload)
         elif packet_type == 0x06:
-            self._parse_command_once_payload(payload)
+            self._parse_command_once_payload(teensy_wrapper, payload)
 
-    def _parse_register_payload(self, payload):
+    def _parse_register_payload(self, teensy_wrapper, payload):
         registration_type = ord(payload[4])
         if registration_type == 0x00:
             data_type = Dataref.TYPE_COMMAND
@@ -141,65 +336,66 @@ class TeensyPanelDriver(PanelDriver):
 
         registration_id = struct.unpack("<H", payload[2:4])[0]
         name = payload[6:]
-        self._registration_map[registration_id] = name
-        logging.info("Panel %s registered %s '%s' with id %s"
-                     % (self._teensy_wrapper.outbound_queue.fileno(), data_type, name, registration_id))
+        teensy_wrapper.registration_map[registration_id] = name
+        logging.info("Panel %s registered %s '%s' with id %s",
+                     teensy_wrapper.outbound_queue.fileno(), data_type, name, registration_id)
 
         Dataref.register(name, data_type)
         dataref = Dataref.factory(name, None)
         packet = packets.DataSubscribeRequest(dataref)
         self.send_packet_to_exchange(packet)
+        self._restore_last_value(teensy_wrapper, name)
 
-    def _parse_write_payload(self, payload):
+    def _parse_write_payload(self, teensy_wrapper, payload):
         data_type = ord(payload[4])
         if data_type == 0x01:
-            value = struct.unpack("<i", payload[6:])
+            value = struct.unpack("<i", payload[6:10])[0]
         elif data_type == 0x02:
-            value = struct.unpack("<f", payload[6:])
+            value = struct.unpack("<f", payload[6:10])[0]
         else:
             raise IOError("unsupported write data type")
 
         registration_id = struct.unpack("<H", payload[2:4])[0]
-        name = self._registration_map[registration_id]
-        logging.info("Panel %s wrote %s to %s"
-                     % (self._teensy_wrapper.outbound_queue.fileno(), value, name))
+        name = teensy_wrapper.registration_map[registration_id]
+        logging.info("Panel %s wrote %s to %s",
+                     teensy_wrapper.outbound_queue.fileno(), value, name)
 
         dataref = Dataref.factory(name, value)
         packet = packets.DataWrite(dataref)
-        self.send_packet_to_exchange(packet)
+        self.send_packet_to_exchange(packet, source=teensy_wrapper.get_device_info().path)
 
-    def _parse_command_begin_payload(self, payload):
+    def _parse_command_begin_payload(self, teensy_wrapper, payload):
         registration_id = struct.unpack("<H", payload[2:4])[0]
-        command = self._registration_map[registration_id]
-        logging.info("Panel %s began command for %s" % (self._teensy_wrapper.outbound_queue.fileno(), command))
+        command = teensy_wrapper.registration_map[registration_id]
+        logging.info("Panel %s began command for %s", teensy_wrapper.outbound_queue.fileno(), command)
 
         dataref = Dataref.factory(command, Dataref.COMMAND_BEGIN)
         packet = packets.CommandBegin(dataref)
-        self.send_packet_to_exchange(packet)
+        self.send_packet_to_exchange(packet, source=teensy_wrapper.get_device_info().path)
 
-    def _parse_command_end_payload(self, payload):
+    def _parse_command_end_payload(self, teensy_wrapper, payload):
         registration_id = struct.unpack("<H", payload[2:4])[0]
-        command = self._registration_map[registration_id]
-        logging.info("Panel %s ended command for %s" % (self._teensy_wrapper.outbound_queue.fileno(), command))
+        command = teensy_wrapper.registration_map[registration_id]
+        logging.info("Panel %s ended command for %s", teensy_wrapper.outbound_queue.fileno(), command)
 
         dataref = Dataref.factory(command, Dataref.COMMAND_END)
         packet = packets.CommandEnd(dataref)
-        self.send_packet_to_exchange(packet)
+        self.send_packet_to_exchange(packet, source=teensy_wrapper.get_device_info().path)
 
-    def _parse_command_once_payload(self, payload):
+    def _parse_command_once_payload(self, teensy_wrapper, payload):
         registration_id = struct.unpack("<H", payload[2:4])[0]
-        command = self._registration_map[registration_id]
-        logging.info("Panel %s activated command once for %s" % (self._teensy_wrapper.outbound_queue.fileno(), command))
+        command = teensy_wrapper.registration_map[registration_id]
+        logging.info("Panel %s activated command once for %s", teensy_wrapper.outbound_queue.fileno(), command)
 
         dataref = Dataref.factory(command, Dataref.COMMAND_ONCE)
         packet = packets.CommandOnce(dataref)
-        self.send_packet_to_exchange(packet)
+        self.send_packet_to_exchange(packet, source=teensy_wrapper.get_device_info().path)
 
     @staticmethod
     def _extract_payloads_from_buffer(data):
         found_payloads = []
         payload_size = ord(data[0])
-        while 1 < payload_size < len(data):
+        while 1 < payload_size <= len(data):
             found_payloads.append(data[0:payload_size])
             data = data[payload_size:]
             if len(data) > 0:
@@ -208,7 +404,15 @@ class TeensyPanelDriver(PanelDriver):
                 payload_size = 0
         return found_payloads
 
-    def _build_data_write_payload(self, dataref):
+    @staticmethod
+    def _find_registration_id(registration_map, name):
+        for map_id in registration_map:
+            if registration_map[map_id] == name:
+                return map_id
+        return None
+
+    @staticmethod
+    def _build_data_write_payload(registration_id, dataref):
         if isinstance(dataref, DatarefInteger):
             data_type = 0x01
             symbol = "i"
@@ -218,11 +422,4 @@ class TeensyPanelDriver(PanelDriver):
         else:
             raise NotImplementedError("dataref type %s not implemented" % dataref.__class__.__name__)
 
-        registration_id = None
-        for map_id in self._registration_map:
-            if self._registration_map[map_id] == dataref.get_name():
-                registration_id = map_id
-        if not registration_id:
-            raise KeyError("could not find a dataref registration for %s" % dataref.get_name())
-
         return struct.pack("<BBHBB" + symbol, 10, 2, registration_id, data_type, 0, dataref.get_value())
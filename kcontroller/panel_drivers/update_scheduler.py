@@ -0,0 +1,117 @@
+class UpdateScheduler(object):
+    """Packs dataref updates for one panel into outgoing reports within the panel's report budget.
+
+    Only the latest value of each dataref is kept until it is sent. Pending control payloads go first,
+    then the updates that waited the longest weighted by their priority, skipping datarefs sent more
+    recently than their maximum refresh rate allows. Priorities and maximum refresh rates are configured
+    per dataref name.
+
+    Each report carries a single payload, which is what the panel firmware reads. With pack_reports,
+    several payloads share a report, leaving at least the last byte free so a payload never ends exactly
+    at the end of the report.
+    """
+
+    def __init__(self, report_size=64, reports_per_second=100.0, priorities=None, max_refresh_rates=None,
+                 pack_reports=False):
+        self._report_size = report_size
+        self._pack_reports = pack_reports
+        self._report_interval = 1.0 / reports_per_second
+        self._priorities = priorities if priorities else {}
+        self._min_intervals = dict((name, 1.0 / rate) for name, rate in (max_refresh_rates or {}).iteritems())
+
+        self._control_payloads = []
+        self._pending_updates = {}
+        self._next_report = 0.0
+        self._stats = {}
+        self._reports = 0
+
+    def add_control(self, payload):
+        self._control_payloads.append(payload)
+
+    def add_update(self, name, payload, now):
+        stats = self._get_stats(name)
+        if name in self._pending_updates:
+            stats["superseded"] += 1
+            # staleness counts from the oldest value the panel has not seen yet
+            self._pending_updates[name] = (payload, self._pending_updates[name][1])
+        else:
+            self._pending_updates[name] = (payload, now)
+
+    def get_next_deadline(self):
+        """Return when next_report can produce a report, or None when there is nothing to send."""
+        if self._control_payloads:
+            return self._next_report
+        deadlines = [self._get_eligible_time(name) for name in self._pending_updates]
+        return max(self._next_report, min(deadlines)) if deadlines else None
+
+    def next_report(self, now):
+        """Return the report to send now, or None when the budget or the refresh rates do not allow one."""
+        if now < self._next_report:
+            return None
+        report = ""
+        capacity = self._report_size - 1 if self._pack_reports else self._report_size
+        while self._control_payloads and len(report) + len(self._control_payloads[0]) <= capacity:
+            report += self._control_payloads.pop(0)
+            if not self._pack_reports:
+                return self._finish_report(report, now)
+
+        candidates = [(name, (now - since) * self._priorities.get(name, 1.0))
+                      for name, (payload, since) in self._pending_updates.iteritems()
+                      if self._get_eligible_time(name) <= now]
+        candidates.sort(key=lambda candidate: candidate[1], reverse=True)
+        for name, _ in candidates:
+            payload, since = self._pending_updates[name]
+            if len(report) + len(payload) > capacity:
+                continue
+            report += payload
+            del self._pending_updates[name]
+            stats = self._stats[name]
+            if stats["first_sent"] is None:
+                stats["first_sent"] = now
+            stats["last_sent"] = now
+            stats["max_staleness"] = max(stats["max_staleness"], now - since)
+            # counted last, get_stats only reads the times of datarefs that were sent
+            stats["sent"] += 1
+            if not self._pack_reports:
+                break
+
+        return self._finish_report(report, now) if report else None
+
+    def get_report_count(self):
+        return self._reports
+
+    def get_stats(self, now):
+        """Return the updates sent and superseded, achieved refresh rate and maximum staleness of each dataref.
+
+        Safe to call from another thread than the one sending the reports.
+        """
+        stats = {}
+        # items() copies in one step, the sending thread may add datarefs meanwhile
+        for name, dataref_stats in self._stats.items():
+            elapsed = dataref_stats["last_sent"] - dataref_stats["first_sent"] if dataref_stats["sent"] else 0
+            pending = self._pending_updates.get(name)
+            stats[name] = {
+                "sent": dataref_stats["sent"],
+                "superseded": dataref_stats["superseded"],
+                "refresh_rate": (dataref_stats["sent"] - 1) / elapsed if elapsed > 0 else 0.0,
+                # an update still waiting is as stale as it has been waiting
+                "max_staleness": max(dataref_stats["max_staleness"], now - pending[1] if pending else 0.0),
+            }
+        return stats
+
+    def _finish_report(self, report, now):
+        self._reports += 1
+        self._next_report = now + self._report_interval
+        return report
+
+    def _get_stats(self, name):
+        if name not in self._stats:
+            self._stats[name] = {"sent": 0, "superseded": 0, "max_staleness": 0.0, "first_sent": None,
+                                 "last_sent": None}
+        return self._stats[name]
+
+    def _get_eligible_time(self, name):
+        last_sent = self._stats[name]["last_sent"]
+        if last_sent is None or name not in self._min_intervals:
+            return 0.0
+        return last_sent + self._min_intervals[name]
@@ -0,0 +1,179 @@
+from collections import Counter
+import ctypes
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _load_thread_cpu_clock():
+    # thread.ident is the pthread_t of the thread on Linux, which lets us read the CPU clock of any live thread
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        getcpuclockid = libc.pthread_getcpuclockid
+        gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    getcpuclockid.argtypes = [ctypes.c_ulong, ctypes.POINTER(ctypes.c_int)]
+    gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+    return getcpuclockid, gettime
+
+
+_thread_cpu_clock = _load_thread_cpu_clock()
+
+
+def get_thread_cpu_time(ident):
+    """Return the CPU time in seconds consumed by the live thread with the given ident, None if unavailable."""
+    if not _thread_cpu_clock:
+        return None
+    getcpuclockid, gettime = _thread_cpu_clock
+    clock_id = ctypes.c_int()
+    if getcpuclockid(ident, ctypes.byref(clock_id)) != 0:
+        return None
+    timespec = _Timespec()
+    if gettime(clock_id, ctypes.byref(timespec)) != 0:
+        return None
+    return timespec.tv_sec + timespec.tv_nsec / 1e9
+
+
+class SamplingProfiler(threading.Thread):
+    """Samples the stacks of every thread while enabled, costing nothing but a parked thread while disabled.
+
+    Samples are attributed to thread names and can be exported as collapsed stacks, one
+    "thread;outer;...;leaf count" line per distinct stack, as consumed by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval=0.005, hot_function_count=10):
+        super(SamplingProfiler, self).__init__(name="SamplingProfiler")
+        self.daemon = True
+        self._interval = interval
+        self._hot_function_count = hot_function_count
+        self._enabled = threading.Event()
+        self._lock = threading.Lock()
+        self._stacks = Counter()
+        self._started_at = None
+        self._stopped_at = None
+        self._start_cpu_times = {}
+        self._cpu_times = {}
+
+    def is_profiling(self):
+        return self._enabled.is_set()
+
+    def start_profiling(self):
+        with self._lock:
+            if self._enabled.is_set():
+                return
+            self._stacks = Counter()
+            self._started_at = time.time()
+            self._stopped_at = None
+            self._start_cpu_times = self._read_cpu_times()
+            self._cpu_times = {}
+        if not self.is_alive():
+            self.start()
+        self._enabled.set()
+        logging.info("Sampling profiler started with a %sms interval", self._interval * 1000)
+
+    def stop_profiling(self):
+        with self._lock:
+            if not self._enabled.is_set():
+                return
+            self._enabled.clear()
+            self._stopped_at = time.time()
+            self._cpu_times = self._get_cpu_times_since_start()
+        logging.info("Sampling profiler stopped after %.1fs and %s sample(s)",
+                     self._stopped_at - self._started_at, sum(self._stacks.values()))
+
+    def toggle(self):
+        if self.is_profiling():
+            self.stop_profiling()
+        else:
+            self.start_profiling()
+
+    def get_collapsed_stacks(self):
+        with self._lock:
+            return ["%s %s" % (stack, count) for stack, count in sorted(self._stacks.items())]
+
+    def write_collapsed_stacks(self, directory=None):
+        file_name = os.path.join(directory if directory else tempfile.gettempdir(),
+                                 "kcontroller-profile-%s-%s.folded" % (os.getpid(), int(time.time())))
+        with open(file_name, "w") as f:
+            for line in self.get_collapsed_stacks():
+                f.write(line + "\n")
+        return file_name
+
+    def get_report(self):
+        with self._lock:
+            if self._started_at is None:
+                return {"profiling": False, "threads": {}}
+            cpu_times = self._get_cpu_times_since_start() if self._enabled.is_set() else self._cpu_times
+            threads = {}
+            for stack, count in self._stacks.iteritems():
+                frames = stack.split(";")
+                thread = threads.setdefault(frames[0], {"samples": 0, "cpu_time": None, "self_samples": Counter()})
+                thread["samples"] += count
+                if len(frames) > 1:
+                    thread["self_samples"][frames[-1]] += count
+            for thread_name, cpu_time in cpu_times.iteritems():
+                threads.setdefault(thread_name, {"samples": 0, "cpu_time": None, "self_samples": Counter()})
+                threads[thread_name]["cpu_time"] = cpu_time
+            for thread in threads.values():
+                thread["hot_functions"] = thread.pop("self_samples").most_common(self._hot_function_count)
+            return {
+                "profiling": self._enabled.is_set(),
+                "duration": (self._stopped_at if self._stopped_at else time.time()) - self._started_at,
+                "threads": threads,
+            }
+
+    def log_report(self):
+        report = self.get_report()
+        for thread_name, thread in sorted(report["threads"].items()):
+            cpu_time = "%.3f" % thread["cpu_time"] if thread["cpu_time"] is not None else "unknown"
+            hot_functions = ", ".join("%s (%s)" % hot_function for hot_function in thread["hot_functions"][:3])
+            logging.info("Profiled thread %s: %s sample(s), %s CPU second(s), hottest %s",
+                         thread_name, thread["samples"], cpu_time, hot_functions)
+
+    def run(self):
+        while True:
+            self._enabled.wait()
+            self._sample()
+            time.sleep(self._interval)
+
+    def _sample(self):
+        thread_names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        own_ident = threading.current_thread().ident
+        samples = []
+        for ident, frame in sys._current_frames().iteritems():
+            if ident == own_ident:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            frames.append(thread_names.get(ident, "thread-%s" % ident))
+            samples.append(";".join(reversed(frames)))
+        with self._lock:
+            if self._enabled.is_set():
+                self._stacks.update(samples)
+
+    def _read_cpu_times(self):
+        cpu_times = {}
+        for thread in threading.enumerate():
+            if thread is not self and thread.is_alive():
+                cpu_time = get_thread_cpu_time(thread.ident)
+                if cpu_time is not None:
+                    cpu_times[thread.name] = cpu_time
+        return cpu_times
+
+    def _get_cpu_times_since_start(self):
+        return dict((thread_name, cpu_time - self._start_cpu_times.get(thread_name, 0.0))
+                    for thread_name, cpu_time in self._read_cpu_times().iteritems())
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,54 @@
+import logging
+import os
+from kcontroller import PollableQueue
+
+# usage page 0xff1c, usage 0xa739, application collection, input report, end collection
+TEENSY_DESCRIPTOR = "\x06\x1c\xff\x0a\x39\xa7\xa1\x01\x75\x08\x95\x40\x81\x02\xc0"
+
+
+def make_sysfs_device(root, name, vid, pid, descriptor=TEENSY_DESCRIPTOR, phys="usb-0000:00:14.0-1/input0", uniq=""):
+    device_path = os.path.join(root, name, "device")
+    os.makedirs(device_path)
+    with open(os.path.join(device_path, "uevent"), "w") as f:
+        f.write("DRIVER=hid-generic\nHID_ID=0003:%08X:%08X\nHID_NAME=Teensyduino RawHID\nHID_PHYS=%s\nHID_UNIQ=%s\n"
+                % (vid, pid, phys, uniq))
+    with open(os.path.join(device_path, "report_descriptor"), "wb") as f:
+        f.write(descriptor)
+
+
+class RecordingPanelDriver(object):
+    """Stands in for a panel driver, recording the packets sent to it."""
+
+    def __init__(self):
+        self.packets = []
+        self.outbound_queue = PollableQueue()
+
+    def get_inbound_queue(self):
+        return self
+
+    def get_outbound_queue(self):
+        return self.outbound_queue
+
+    def put(self, packet):
+        self.packets.append(packet)
+
+
+class LogCapture(logging.Handler):
+    """Records what is logged while it is used as a context manager."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def __enter__(self):
+        logging.getLogger().addHandler(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        logging.getLogger().removeHandler(self)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def get_messages(self, level):
+        return [record.getMessage() for record in self.records if record.levelno == level]
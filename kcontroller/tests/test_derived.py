@@ -0,0 +1,95 @@
+import unittest
+from kcontroller.dataref import Dataref, DatarefFloat, DatarefInteger
+from kcontroller.derived import DerivedDataref, DerivedDatarefEngine
+from kcontroller.exchanges import Exchange
+from kcontroller.exchanges.inet_socket import InetSocketExchange
+from kcontroller.tests.helpers import RecordingPanelDriver
+
+
+class DerivedDatarefEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = DerivedDatarefEngine.from_config([
+            {"name": "test_derived/altitude_km", "type": "float", "expression": "altitude / 1000.0",
+             "inputs": {"altitude": "test_derived/altitude"}},
+            {"name": "test_derived/high", "type": "integer", "expression": "int(km > limit)",
+             "inputs": {"km": "test_derived/altitude_km", "limit": "test_derived/limit"}},
+        ])
+
+    def test_evaluate_returns_changed_derived_values_in_dependency_order(self):
+        self.engine.update("test_derived/altitude", 1500)
+        self.engine.update("test_derived/limit", 1)
+        self.assertEqual(self.engine.evaluate(), [("test_derived/altitude_km", 1.5), ("test_derived/high", 1)])
+        self.assertEqual(self.engine.get_value("test_derived/high"), 1)
+
+    def test_unchanged_inputs_are_not_recomputed(self):
+        self.engine.update("test_derived/altitude", 1500)
+        self.engine.update("test_derived/limit", 1)
+        self.engine.evaluate()
+        self.engine.update("test_derived/altitude", 1500)
+        self.assertEqual(self.engine.evaluate(), [])
+        self.engine.update("test_derived/altitude", 1600)
+        self.assertEqual(self.engine.evaluate(), [("test_derived/altitude_km", 1.6)])
+
+    def test_missing_inputs_skip_evaluation(self):
+        self.engine.update("test_derived/altitude", 1500)
+        self.assertEqual(self.engine.evaluate(), [("test_derived/altitude_km", 1.5)])
+
+    def test_source_names_resolve_through_derived_inputs(self):
+        self.assertEqual(self.engine.get_source_names("test_derived/high"),
+                         set(["test_derived/altitude", "test_derived/limit"]))
+        self.assertTrue(self.engine.is_derived("test_derived/high"))
+        self.assertTrue(self.engine.is_input("test_derived/altitude"))
+        self.assertFalse(self.engine.is_input("test_derived/altitude_km"))
+
+    def test_inputs_keep_the_type_panels_register(self):
+        Dataref.register("test_derived/altitude", Dataref.TYPE_INTEGER)
+        self.assertIsInstance(self.engine.get_source_dataref("test_derived/altitude"), DatarefInteger)
+        driver = RecordingPanelDriver()
+        exchange = Exchange(panel_drivers=[driver], derived_datarefs=self.engine)
+        exchange.send_dataref_write("test_derived/altitude", 1500)
+        self.assertIsInstance(driver.packets[0].get_dataref(), DatarefInteger)
+        self.assertEqual(driver.packets[0].get_dataref().get_value(), 1500)
+
+    def test_unregistered_inputs_still_feed_the_engine(self):
+        self.assertIsInstance(self.engine.get_source_dataref("test_derived/limit"), DatarefFloat)
+        self.assertRaises(KeyError, Dataref.factory, "test_derived/limit", None)
+        exchange = Exchange(panel_drivers=[RecordingPanelDriver()], derived_datarefs=self.engine)
+        exchange.send_dataref_write("test_derived/limit", 2)
+        self.assertEqual(self.engine.get_value("test_derived/limit"), 2)
+
+    def test_failing_expression_is_skipped(self):
+        engine = DerivedDatarefEngine([DerivedDataref("test_derived/ratio", "float", "a / b",
+                                                      {"a": "test_derived/a", "b": "test_derived/b"})])
+        engine.update("test_derived/a", 1)
+        engine.update("test_derived/b", 0)
+        self.assertEqual(engine.evaluate(), [])
+
+    def test_cycles_and_bad_types_are_rejected(self):
+        self.assertRaises(ValueError, DerivedDatarefEngine, [
+            DerivedDataref("test_derived/x", "float", "y", {"y": "test_derived/y"}),
+            DerivedDataref("test_derived/y", "float", "x", {"x": "test_derived/x"}),
+        ])
+        self.assertRaises(ValueError, DerivedDataref, "test_derived/z", "string", "1", {"a": "b"})
+
+    def test_socket_exchange_inputs_are_coerced(self):
+        Dataref.register("test_derived/socket_limit", Dataref.TYPE_INTEGER)
+        engine = DerivedDatarefEngine.from_config([
+            {"name": "test_derived/socket_km", "type": "float", "expression": "altitude / 1000.0",
+             "inputs": {"altitude": "test_derived/socket_altitude"}},
+            {"name": "test_derived/socket_low", "type": "integer", "expression": "int(altitude < limit)",
+             "inputs": {"altitude": "test_derived/socket_altitude", "limit": "test_derived/socket_limit"}},
+        ])
+        exchange = InetSocketExchange(["127.0.0.1", 0], panel_drivers=[RecordingPanelDriver()],
+                                      derived_datarefs=engine)
+        try:
+            exchange._parse_payload("update test_derived/socket_altitude=1500,test_derived/socket_limit=2000")
+        finally:
+            exchange._server_socket.close()
+        self.assertEqual(engine.get_value("test_derived/socket_altitude"), 1500.0)
+        self.assertEqual(engine.get_value("test_derived/socket_limit"), 2000)
+        self.assertEqual(sorted(engine.evaluate()), [("test_derived/socket_km", 1.5), ("test_derived/socket_low", 1)])
+
+    def test_invalid_input_values_are_discarded(self):
+        exchange = Exchange(panel_drivers=[RecordingPanelDriver()], derived_datarefs=self.engine)
+        exchange.send_dataref_write("test_derived/altitude", "high")
+        self.assertEqual(self.engine.get_value("test_derived/altitude"), None)
@@ -0,0 +1,79 @@
+import os
+import socket
+import unittest
+from kcontroller import gateway
+from kcontroller.dataref import Dataref, DatarefCommand, DatarefFloat, DatarefInteger
+
+
+class FrameTest(unittest.TestCase):
+    def test_round_trip(self):
+        entries = [[gateway.ENTRY_SUBSCRIBE, "v.altitude", Dataref.TYPE_FLOAT], [gateway.ENTRY_SIMULATION, True]]
+        reader = gateway.FrameReader()
+        reader.feed(gateway.encode_frame(entries))
+        self.assertEqual(reader.read_entries(), entries)
+
+    def test_large_frames_are_compressed(self):
+        entries = [[gateway.ENTRY_UPDATE, "v.altitude", value] for value in range(100)]
+        frame = gateway.encode_frame(entries)
+        length, flags = gateway.FRAME_HEADER.unpack_from(frame)
+        self.assertTrue(flags & gateway.FLAG_COMPRESSED)
+        self.assertEqual(length, len(frame) - gateway.FRAME_HEADER.size)
+        reader = gateway.FrameReader()
+        reader.feed(frame)
+        self.assertEqual(reader.read_entries(), entries)
+
+    def test_partial_frames_wait_for_the_rest(self):
+        frames = gateway.encode_frame([[gateway.ENTRY_UPDATE, "a", 1]]) + gateway.encode_frame([[gateway.ENTRY_UPDATE, "b", 2]])
+        reader = gateway.FrameReader()
+        received = []
+        for index in range(len(frames)):
+            reader.feed(frames[index])
+            received.extend(reader.read_entries())
+        self.assertEqual(received, [[gateway.ENTRY_UPDATE, "a", 1], [gateway.ENTRY_UPDATE, "b", 2]])
+
+    def test_oversized_frame_header_is_rejected(self):
+        reader = gateway.FrameReader()
+        reader.feed(gateway.FRAME_HEADER.pack(gateway.MAX_FRAME_SIZE + 1, 0))
+        self.assertRaises(ValueError, reader.read_entries)
+
+    def test_data_types(self):
+        self.assertEqual(gateway.get_data_type(DatarefInteger("a", None)), Dataref.TYPE_INTEGER)
+        self.assertEqual(gateway.get_data_type(DatarefFloat("a", None)), Dataref.TYPE_FLOAT)
+        self.assertEqual(gateway.get_data_type(DatarefCommand("a", None)), Dataref.TYPE_COMMAND)
+        self.assertRaises(NotImplementedError, gateway.get_data_type, Dataref("a", None))
+
+
+class FrameWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.local, self.remote = socket.socketpair()
+        self.local.setblocking(0)
+        self.writer = gateway.FrameWriter(self.local)
+
+    def tearDown(self):
+        self.local.close()
+        self.remote.close()
+
+    def test_flush_keeps_what_the_socket_does_not_accept(self):
+        entries = [[gateway.ENTRY_UPDATE, "name/%s" % index, index] for index in range(20)]
+        frames = 0
+        while True:
+            self.writer.write(entries)
+            frames += 1
+            if not self.writer.flush():
+                break
+        self.assertTrue(self.writer.wants_write())
+
+        reader = gateway.FrameReader()
+        received = []
+        self.remote.settimeout(1)
+        while len(received) < frames * len(entries):
+            reader.feed(self.remote.recv(65536))
+            received.extend(reader.read_entries())
+            self.writer.flush()
+        self.assertFalse(self.writer.wants_write())
+        self.assertEqual(received[-1], entries[-1])
+
+    def test_stalled_peer_is_reported(self):
+        # random values so compression cannot shrink the frames
+        entries = [[gateway.ENTRY_UPDATE, "name/%s" % index, os.urandom(500).encode("hex")] for index in range(100)]
+        self.assertRaises(IOError, lambda: [self.writer.write(entries) for _ in range(20)])
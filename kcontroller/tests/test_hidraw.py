@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import unittest
+from kcontroller.panel_drivers import hidraw
+from kcontroller.tests.helpers import TEENSY_DESCRIPTOR, make_sysfs_device
+
+
+class ParseTopLevelUsageTest(unittest.TestCase):
+    def test_first_usage_page_and_usage(self):
+        self.assertEqual(hidraw._parse_top_level_usage(TEENSY_DESCRIPTOR), (0xff1c, 0xa739))
+
+    def test_long_items_are_skipped(self):
+        # a long item whose data would otherwise parse as a usage page of 0x0001
+        descriptor = "\xfe\x02\x10\x05\x01" + TEENSY_DESCRIPTOR
+        self.assertEqual(hidraw._parse_top_level_usage(descriptor), (0xff1c, 0xa739))
+
+    def test_stops_at_the_first_collection(self):
+        descriptor = "\x05\x01\xa1\x01\x09\x02\xc0"
+        self.assertEqual(hidraw._parse_top_level_usage(descriptor), (0x01, None))
+
+    def test_empty_descriptor(self):
+        self.assertEqual(hidraw._parse_top_level_usage(""), (None, None))
+
+
+class FindDevicesTest(unittest.TestCase):
+    def setUp(self):
+        self.sysfs = tempfile.mkdtemp()
+        self.sysfs_path = hidraw.SYSFS_HIDRAW_PATH
+        hidraw.SYSFS_HIDRAW_PATH = self.sysfs
+        make_sysfs_device(self.sysfs, "hidraw0", 0x16c0, 0x0488, uniq="1234")
+        # the keyboard interface of the same board
+        make_sysfs_device(self.sysfs, "hidraw1", 0x16c0, 0x0488, descriptor="\x05\x01\x09\x06\xa1\x01\xc0")
+        make_sysfs_device(self.sysfs, "hidraw2", 0x046d, 0xc52b)
+
+    def tearDown(self):
+        hidraw.SYSFS_HIDRAW_PATH = self.sysfs_path
+        shutil.rmtree(self.sysfs)
+
+    def test_vid_and_pid(self):
+        self.assertEqual([device_info.name for device_info in hidraw.find_devices(0x16c0, 0x0488)],
+                         ["hidraw0", "hidraw1"])
+
+    def test_usage(self):
+        device_infos = hidraw.find_devices(0x16c0, 0x0488, usage=0xa739, usage_page=0xff1c)
+        self.assertEqual([device_info.name for device_info in device_infos], ["hidraw0"])
+        self.assertEqual(device_infos[0].path, "/dev/hidraw0")
+        self.assertEqual(device_infos[0].get_identity(), "1234")
+
+    def test_identity_falls_back_to_the_physical_path(self):
+        device_info = hidraw.find_devices(0x16c0, 0x0488, usage=0x06)[0]
+        self.assertEqual(device_info.get_identity(), "usb-0000:00:14.0-1/input0")
+
+    def test_unreadable_devices_are_skipped(self):
+        os.remove(os.path.join(self.sysfs, "hidraw0", "device", "report_descriptor"))
+        self.assertEqual([device_info.name for device_info in hidraw.find_devices(0x16c0, 0x0488)], ["hidraw1"])
+
+    def test_missing_sysfs(self):
+        hidraw.SYSFS_HIDRAW_PATH = os.path.join(self.sysfs, "missing")
+        self.assertEqual(hidraw.find_devices(0x16c0, 0x0488), [])
@@ -0,0 +1,43 @@
+import select
+import socket
+import unittest
+from kcontroller import packets
+from kcontroller.dataref import DatarefFloat
+from kcontroller.exchanges.inet_socket import InetSocketExchange
+from kcontroller.tests.helpers import RecordingPanelDriver
+
+
+class InetSocketExchangeTest(unittest.TestCase):
+    def setUp(self):
+        self.exchange = InetSocketExchange(["127.0.0.1", 0], panel_drivers=[RecordingPanelDriver()])
+        self.exchange.start(select.poll())
+        self.client = None
+
+    def tearDown(self):
+        if self.client:
+            self.client.close()
+        self.exchange.stop()
+
+    def _connect(self):
+        self.client = socket.create_connection(self.exchange._server_socket.getsockname())
+        self.client.settimeout(1.0)
+        self.exchange.handle_activity(self.exchange._poller.poll(1000))
+
+    def _receive_lines(self, count):
+        self.exchange.handle_timers()
+        data = ""
+        while data.count("\n") < count:
+            data += self.client.recv(4096)
+        return data.splitlines()
+
+    def test_registrations_are_sent_when_a_client_connects(self):
+        self.exchange.handle_panel_packet(packets.DataSubscribeRequest(DatarefFloat("v.altitude", None)))
+        self.exchange.handle_panel_packet(packets.DataWrite(DatarefFloat("v.altitude", 5)))
+        self._connect()
+        self.assertEqual(self._receive_lines(1), ["register v.altitude float"])
+
+    def test_unicode_names(self):
+        # the gateway decodes names from JSON
+        self._connect()
+        self.exchange.handle_panel_packet(packets.DataWrite(DatarefFloat(u"v.altitude", 5)))
+        self.assertEqual(self._receive_lines(1), ["update v.altitude 5.0"])
@@ -0,0 +1,20 @@
+import unittest
+from kcontroller import PollableQueue, packets
+from kcontroller.dataref import Dataref
+from kcontroller.panel_drivers.inet_socket import InetSocketPanelDriver
+
+
+class InetSocketPanelDriverTest(unittest.TestCase):
+    def setUp(self):
+        self.driver = InetSocketPanelDriver(["127.0.0.1", 0], debounce_window=0.01, inbound_queue=PollableQueue(),
+                                            outbound_queue=PollableQueue())
+        Dataref.register("test/socket/gear", Dataref.TYPE_COMMAND)
+
+    def tearDown(self):
+        self.driver._server_socket.close()
+
+    def test_boards_are_debounced_independently(self):
+        self.driver._parse_payload("command test/socket/gear begin", source="10.0.0.2:40001")
+        self.driver._parse_payload("command test/socket/gear begin", source="10.0.0.3:40002")
+        released = self.driver._input_filter.release(1.0e12)
+        self.assertEqual([packet.__class__ for packet in released], [packets.CommandBegin, packets.CommandBegin])
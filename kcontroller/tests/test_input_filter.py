@@ -0,0 +1,74 @@
+import unittest
+from kcontroller import packets
+from kcontroller.dataref import DatarefCommand, DatarefInteger
+from kcontroller.panel_drivers.input_filter import InputFilter
+
+
+def _command(packet_class, name="sim/command"):
+    return packet_class(DatarefCommand(name, None))
+
+
+def _write(value, name="sim/value"):
+    return packets.DataWrite(DatarefInteger(name, value))
+
+
+class InputFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.input_filter = InputFilter(debounce_window=0.01, coalesce_window=0.02)
+
+    def test_settled_edge_is_forwarded_after_window(self):
+        self.assertEqual(self.input_filter.filter(_command(packets.CommandBegin), 0.0), [])
+        self.assertEqual(self.input_filter.release(0.005), [])
+        released = self.input_filter.release(0.01)
+        self.assertEqual([packet.__class__ for packet in released], [packets.CommandBegin])
+
+    def test_bounce_forwards_settled_state_only(self):
+        self.input_filter.filter(_command(packets.CommandBegin), 0.0)
+        self.input_filter.filter(_command(packets.CommandEnd), 0.002)
+        self.input_filter.filter(_command(packets.CommandBegin), 0.004)
+        released = self.input_filter.release(0.02)
+        self.assertEqual([packet.__class__ for packet in released], [packets.CommandBegin])
+
+    def test_short_tap_is_absorbed_as_a_pair(self):
+        self.input_filter.filter(_command(packets.CommandBegin), 0.0)
+        self.input_filter.filter(_command(packets.CommandEnd), 0.005)
+        self.assertEqual(self.input_filter.release(0.02), [])
+        self.assertEqual(self.input_filter.get_counters()["absorbed_command_edges"], 2)
+
+    def test_press_and_release_are_forwarded_as_a_pair(self):
+        self.input_filter.filter(_command(packets.CommandBegin), 0.0)
+        begin = self.input_filter.release(0.01)
+        self.input_filter.filter(_command(packets.CommandEnd), 0.1)
+        end = self.input_filter.release(0.11)
+        self.assertEqual([packet.__class__ for packet in begin + end], [packets.CommandBegin, packets.CommandEnd])
+
+    def test_sources_are_debounced_separately(self):
+        self.input_filter.filter(_command(packets.CommandOnce), 0.0, source="panel-a")
+        forwarded = self.input_filter.filter(_command(packets.CommandOnce), 0.002, source="panel-b")
+        self.assertEqual(len(forwarded), 1)
+        self.input_filter.filter(_command(packets.CommandBegin), 0.0, source="panel-a")
+        self.input_filter.filter(_command(packets.CommandBegin), 0.002, source="panel-b")
+        self.assertEqual(len(self.input_filter.release(0.02)), 2)
+
+    def test_repeated_command_once_is_absorbed(self):
+        self.assertEqual(len(self.input_filter.filter(_command(packets.CommandOnce), 0.0)), 1)
+        self.assertEqual(self.input_filter.filter(_command(packets.CommandOnce), 0.005), [])
+        self.assertEqual(len(self.input_filter.filter(_command(packets.CommandOnce), 0.02)), 1)
+
+    def test_write_burst_is_coalesced_to_latest_value(self):
+        self.assertEqual(len(self.input_filter.filter(_write(1), 0.0)), 1)
+        self.assertEqual(self.input_filter.filter(_write(2), 0.005), [])
+        self.assertEqual(self.input_filter.filter(_write(3), 0.01), [])
+        self.assertEqual(self.input_filter.get_next_deadline(), 0.02)
+        released = self.input_filter.release(0.02)
+        self.assertEqual([packet.get_dataref().get_value() for packet in released], [3])
+        self.assertEqual(self.input_filter.get_counters()["coalesced_writes"], 1)
+
+    def test_input_windows_override_defaults(self):
+        input_filter = InputFilter(debounce_window=0.01, input_windows={"sim/command": 0})
+        forwarded = input_filter.filter(_command(packets.CommandBegin), 0.0)
+        self.assertEqual([packet.__class__ for packet in forwarded], [packets.CommandBegin])
+
+    def test_other_packets_pass_through(self):
+        packet = packets.SimulationStart()
+        self.assertEqual(self.input_filter.filter(packet, 0.0), [packet])
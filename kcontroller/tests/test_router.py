@@ -0,0 +1,130 @@
+import functools
+import logging
+import select
+import socket
+import threading
+import unittest
+from kcontroller import packets
+from kcontroller.dataref import DatarefCommand
+from kcontroller.exchanges import Exchange
+from kcontroller.exchanges.inet_socket import InetSocketExchange
+from kcontroller.exchanges.router import ExchangeRouter, ExchangeRoute
+from kcontroller.tests.helpers import LogCapture, RecordingPanelDriver
+
+
+class _FailingExchange(Exchange):
+    def _handle_activity(self, ready_list):
+        raise IOError(104, "Connection reset by peer")
+
+    def _handle_timers(self):
+        raise IOError(104, "Connection reset by peer")
+
+
+class _RecordingExchange(Exchange):
+    def __init__(self, *args, **kwargs):
+        super(_RecordingExchange, self).__init__(*args, **kwargs)
+        self.packets = []
+        self.timer_passes = 0
+
+    def _handle_panel_packet(self, packet):
+        self.packets.append(packet)
+
+    def _handle_timers(self):
+        self.timer_passes += 1
+
+
+class ExchangeRouterTest(unittest.TestCase):
+    def setUp(self):
+        self.driver = RecordingPanelDriver()
+        self.telemachus = ExchangeRoute("telemachus", Exchange(panel_drivers=[self.driver]))
+        self.autopilot = ExchangeRoute("autopilot", Exchange(panel_drivers=[self.driver]), ["autopilot/"])
+        self.autopilot_pid = ExchangeRoute("pid", Exchange(panel_drivers=[self.driver]), ["autopilot/pid/"])
+        self.router = ExchangeRouter([self.driver], [self.autopilot, self.telemachus, self.autopilot_pid])
+        for route in (self.telemachus, self.autopilot, self.autopilot_pid):
+            route.exchange.start(select.poll(),
+                                 simulation_listener=functools.partial(self.router._set_simulation_running, route))
+
+    def test_longest_prefix_wins(self):
+        self.assertIs(self.router.get_route("autopilot/heading"), self.autopilot)
+        self.assertIs(self.router.get_route("autopilot/pid/gain"), self.autopilot_pid)
+
+    def test_unmatched_names_go_to_the_route_without_prefixes(self):
+        self.assertIs(self.router.get_route("v.altitude"), self.telemachus)
+        self.assertIs(self.router.get_route("autopilo"), self.telemachus)
+
+    def test_first_route_is_the_default_when_all_have_prefixes(self):
+        router = ExchangeRouter([], [self.autopilot, self.autopilot_pid])
+        self.assertIs(router.get_route("v.altitude"), self.autopilot)
+
+    def test_panels_stop_only_when_no_exchange_is_running(self):
+        self.telemachus.exchange.send_packet_to_panel_drivers(packets.SimulationStart())
+        self.autopilot.exchange.send_packet_to_panel_drivers(packets.SimulationStart())
+        self.autopilot.exchange.send_packet_to_panel_drivers(packets.SimulationStop())
+        self.assertEqual([packet.__class__ for packet in self.driver.packets], [packets.SimulationStart])
+        self.telemachus.exchange.send_packet_to_panel_drivers(packets.SimulationStop())
+        self.assertEqual([packet.__class__ for packet in self.driver.packets],
+                         [packets.SimulationStart, packets.SimulationStop])
+        self.assertFalse(self.router.is_simulation_running())
+
+
+
+class RouteIsolationTest(unittest.TestCase):
+    def setUp(self):
+        self.driver = RecordingPanelDriver()
+        self.telemachus = ExchangeRoute("telemachus", _RecordingExchange(panel_drivers=[self.driver]))
+
+    def _drain(self, router):
+        while not self.driver.outbound_queue.empty() or any(not route.queue.empty() for route in router._routes):
+            router._run_once(0)
+
+    def test_exchange_errors_stay_within_the_exchange(self):
+        failing = ExchangeRoute("failing", _FailingExchange(panel_drivers=[self.driver]), ["failing/"])
+        router = ExchangeRouter([self.driver], [self.telemachus, failing])
+        router._start()
+        local, remote = socket.socketpair()
+        router._poller.register(local, select.POLLIN)
+        router._fileno_routes[local.fileno()] = failing
+        remote.send("x")
+        with LogCapture() as log_capture:
+            router._run_once(0)
+        self.assertEqual(log_capture.get_messages(logging.ERROR), [
+            "exchange _FailingExchange failed to handle activity: [Errno 104] Connection reset by peer",
+            "exchange _FailingExchange failed to handle timers: [Errno 104] Connection reset by peer",
+        ])
+        self.assertEqual(self.telemachus.exchange.timer_passes, 1)
+
+        self.driver.outbound_queue.put(packets.CommandOnce(DatarefCommand("sim/stage", None)))
+        self._drain(router)
+        self.assertEqual([packet.get_command().get_name() for packet in self.telemachus.exchange.packets],
+                         ["sim/stage"])
+        local.close()
+        remote.close()
+
+    def test_peer_that_stops_reading_does_not_block_other_routes(self):
+        autopilot = ExchangeRoute("autopilot", InetSocketExchange(["127.0.0.1", 0], max_send_buffer_size=65536,
+                                                                  panel_drivers=[self.driver]), ["autopilot/"])
+        router = ExchangeRouter([self.driver], [self.telemachus, autopilot])
+        router._start()
+        client = socket.create_connection(autopilot.exchange._server_socket.getsockname())
+        router._run_once(1000)
+        self.assertTrue(router.is_simulation_running())
+
+        def route_packets():
+            # far more than the socket buffers hold, the client never reads any of it
+            for index in xrange(1000):
+                self.driver.outbound_queue.put(packets.CommandOnce(DatarefCommand("autopilot/" + "x" * 16384, None)))
+                self.driver.outbound_queue.put(packets.CommandOnce(DatarefCommand("sim/stage/%s" % index, None)))
+                self._drain(router)
+
+        with LogCapture() as log_capture:
+            thread = threading.Thread(target=route_packets)
+            thread.daemon = True
+            thread.start()
+            thread.join(10)
+        self.assertFalse(thread.is_alive(), "router blocked on the stalled peer")
+        self.assertEqual(len(self.telemachus.exchange.packets), 1000)
+        self.assertIsNone(autopilot.exchange._connection)
+        self.assertFalse(router.is_simulation_running())
+        self.assertTrue([message for message in log_capture.get_messages(logging.WARNING) if "stalled" in message])
+        client.close()
+        autopilot.exchange.stop()
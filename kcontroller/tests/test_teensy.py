@@ -0,0 +1,132 @@
+import select
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from kcontroller import PollableQueue, packets
+from kcontroller.dataref import Dataref, DatarefFloat, DatarefInteger
+from kcontroller.panel_drivers import hidraw
+from kcontroller.panel_drivers.teensy import TeensyPanelDriver, TeensyWrapper
+from kcontroller.tests.helpers import make_sysfs_device
+
+
+class ExtractPayloadsTest(unittest.TestCase):
+    def test_payloads_before_padding(self):
+        data = "\x04\x03\x02\x00" + "\x05\x04abc" + "\x00" * 55
+        self.assertEqual(TeensyPanelDriver._extract_payloads_from_buffer(data), ["\x04\x03\x02\x00", "\x05\x04abc"])
+
+    def test_payload_ending_at_the_end_of_the_report(self):
+        data = "\x04\x03\x02\x00" + "\x3c\x01" + "x" * 58
+        self.assertEqual(TeensyPanelDriver._extract_payloads_from_buffer(data), ["\x04\x03\x02\x00", data[4:]])
+
+    def test_truncated_payload_is_dropped(self):
+        self.assertEqual(TeensyPanelDriver._extract_payloads_from_buffer("\x04\x03\x02\x00\x08\x01ab"),
+                         ["\x04\x03\x02\x00"])
+
+
+class _IdleTeensyWrapper(TeensyWrapper):
+    """Stands in for a connected panel, idling until stopped."""
+
+    def run(self):
+        self._shutdown_flag.wait()
+
+
+class HotplugTest(unittest.TestCase):
+    def setUp(self):
+        self.sysfs = tempfile.mkdtemp()
+        self.sysfs_path = hidraw.SYSFS_HIDRAW_PATH
+        hidraw.SYSFS_HIDRAW_PATH = self.sysfs
+        # no such device node, so opening it fails
+        make_sysfs_device(self.sysfs, "hidraw-missing0", 0x16c0, 0x0488)
+        self.driver = TeensyPanelDriver(rescan_interval=1.0, inbound_queue=PollableQueue(),
+                                        outbound_queue=PollableQueue())
+
+    def tearDown(self):
+        for teensy_wrapper in self.driver._teensy_wrappers.values():
+            teensy_wrapper.stop()
+            teensy_wrapper.join()
+        hidraw.SYSFS_HIDRAW_PATH = self.sysfs_path
+        shutil.rmtree(self.sysfs)
+
+    def _handle_open_failure(self):
+        self.assertEqual(len(self.driver._teensy_wrappers), 1)
+        fileno, teensy_wrapper = self.driver._teensy_wrappers.items()[0]
+        teensy_wrapper.join(5)
+        self.driver._handle_ready([(fileno, select.POLLIN)])
+        self.assertEqual(self.driver._teensy_wrappers, {})
+
+    def test_open_failures_back_off(self):
+        self.driver._rescan_devices()
+        self._handle_open_failure()
+        failures, next_attempt = self.driver._open_failures["/dev/hidraw-missing0"]
+        self.assertEqual(failures, 1)
+        # the next rescan skips the device until its retry time
+        self.driver._rescan_devices()
+        self.assertEqual(self.driver._teensy_wrappers, {})
+
+        self.driver._open_failures["/dev/hidraw-missing0"] = (failures, time.time())
+        self.driver._rescan_devices()
+        self._handle_open_failure()
+        failures, second_attempt = self.driver._open_failures["/dev/hidraw-missing0"]
+        self.assertEqual(failures, 2)
+        self.assertGreater(second_attempt - time.time(), next_attempt - time.time() + 1.0)
+
+    def test_retry_interval_is_capped(self):
+        self.driver._open_failures["/dev/hidraw-missing0"] = (10, time.time())
+        self.driver._rescan_devices()
+        self._handle_open_failure()
+        self.assertLessEqual(self.driver._open_failures["/dev/hidraw-missing0"][1], time.time() + 60.0)
+
+    def test_add_and_change_uevents_clear_the_backoff(self):
+        for action in ("add", "change"):
+            self.driver._open_failures["/dev/hidraw-missing0"] = (3, time.time() + 60.0)
+            self.driver._handle_uevent({"ACTION": action, "DEVNAME": "/dev/hidraw-missing0"})
+            self.assertNotIn("/dev/hidraw-missing0", self.driver._open_failures)
+            # and the device is tried again right away
+            self._handle_open_failure()
+
+    def test_remove_uevent_retires_the_panel(self):
+        device_info = hidraw.HidrawDeviceInfo("hidraw7", 0x16c0, 0x0488, uniq="1234")
+        teensy_wrapper = _IdleTeensyWrapper(device_info, threading.Event())
+        self.driver._teensy_wrappers[teensy_wrapper.outbound_queue.fileno()] = teensy_wrapper
+        self.driver._poller.register(teensy_wrapper.outbound_queue, select.POLLIN)
+        teensy_wrapper.start()
+
+        self.driver._handle_uevent({"ACTION": "remove", "DEVNAME": "/dev/hidraw-other"})
+        self.assertTrue(teensy_wrapper.is_alive())
+        self.driver._handle_uevent({"ACTION": "remove", "DEVNAME": "/dev/hidraw7"})
+        self.assertFalse(teensy_wrapper.is_alive())
+        self.assertEqual(self.driver._teensy_wrappers, {})
+        self.assertEqual(self.driver._open_failures, {})
+
+
+class ParseWritePayloadTest(unittest.TestCase):
+    def setUp(self):
+        self.driver = TeensyPanelDriver(inbound_queue=PollableQueue(), outbound_queue=PollableQueue())
+        self.teensy_wrapper = TeensyWrapper(hidraw.HidrawDeviceInfo("hidraw7", 0x16c0, 0x0488), threading.Event(),
+                                            registration_map={3: "test/teensy/encoder", 4: "test/teensy/trim"})
+        Dataref.register("test/teensy/encoder", Dataref.TYPE_INTEGER)
+        Dataref.register("test/teensy/trim", Dataref.TYPE_FLOAT)
+
+    def _parse_write(self, dataref):
+        payload = TeensyPanelDriver._build_data_write_payload(
+            TeensyPanelDriver._find_registration_id(self.teensy_wrapper.registration_map, dataref.get_name()), dataref)
+        self.driver._parse_payload(self.teensy_wrapper, payload)
+        return self.driver.get_outbound_queue().get(timeout=1)
+
+    def test_integer_write(self):
+        packet = self._parse_write(DatarefInteger("test/teensy/encoder", -42))
+        self.assertIsInstance(packet, packets.DataWrite)
+        self.assertEqual(packet.get_dataref().get_value(), -42)
+
+    def test_float_write(self):
+        packet = self._parse_write(DatarefFloat("test/teensy/trim", 0.25))
+        self.assertEqual(packet.get_dataref().get_value(), 0.25)
+
+    def test_writes_are_coalesced(self):
+        self._parse_write(DatarefInteger("test/teensy/encoder", 1))
+        payload = TeensyPanelDriver._build_data_write_payload(3, DatarefInteger("test/teensy/encoder", 2))
+        self.driver._parse_payload(self.teensy_wrapper, payload)
+        self.assertEqual(self.driver.get_input_filter_counters()["forwarded"], 1)
+        self.assertTrue(self.driver.get_outbound_queue().empty())
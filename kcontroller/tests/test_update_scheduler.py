@@ -0,0 +1,69 @@
+import unittest
+from kcontroller.panel_drivers.update_scheduler import UpdateScheduler
+
+
+def _payload(registration_id, size=10):
+    return chr(size) + "\x02" + chr(registration_id) + "\x00" * (size - 3)
+
+
+class UpdateSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = UpdateScheduler(report_size=64, reports_per_second=100.0)
+
+    def test_one_payload_per_report_by_default(self):
+        self.scheduler.add_control("\x04\x03\x02\x00")
+        self.scheduler.add_update("a", _payload(1), 0.0)
+        self.scheduler.add_update("b", _payload(2), 0.0)
+        self.assertEqual(self.scheduler.next_report(0.0), "\x04\x03\x02\x00")
+        self.assertEqual(self.scheduler.next_report(0.01), _payload(1))
+        self.assertEqual(self.scheduler.next_report(0.02), _payload(2))
+        self.assertEqual(self.scheduler.next_report(0.03), None)
+        self.assertEqual(self.scheduler.get_report_count(), 3)
+
+    def test_reports_stay_within_budget(self):
+        self.scheduler.add_update("a", _payload(1), 0.0)
+        self.scheduler.add_update("b", _payload(2), 0.0)
+        self.assertEqual(self.scheduler.next_report(0.0), _payload(1))
+        self.assertEqual(self.scheduler.next_report(0.005), None)
+        self.assertEqual(self.scheduler.get_next_deadline(), 0.01)
+
+    def test_only_the_latest_value_is_sent(self):
+        self.scheduler.add_update("a", _payload(1), 0.0)
+        self.scheduler.add_update("a", _payload(1, size=12), 0.002)
+        self.assertEqual(self.scheduler.next_report(0.005), _payload(1, size=12))
+        stats = self.scheduler.get_stats(0.005)["a"]
+        self.assertEqual((stats["sent"], stats["superseded"]), (1, 1))
+        # staleness counts from the first value the panel did not see
+        self.assertAlmostEqual(stats["max_staleness"], 0.005)
+
+    def test_priority_outranks_waiting_time(self):
+        scheduler = UpdateScheduler(priorities={"b": 4.0})
+        scheduler.add_update("a", _payload(1), 0.0)
+        scheduler.add_update("b", _payload(2), 0.005)
+        self.assertEqual(scheduler.next_report(0.01), _payload(2))
+
+    def test_max_refresh_rate(self):
+        scheduler = UpdateScheduler(max_refresh_rates={"a": 10.0})
+        scheduler.add_update("a", _payload(1), 0.0)
+        self.assertEqual(scheduler.next_report(0.0), _payload(1))
+        scheduler.add_update("a", _payload(1, size=12), 0.01)
+        self.assertEqual(scheduler.next_report(0.05), None)
+        self.assertAlmostEqual(scheduler.get_next_deadline(), 0.1)
+        self.assertEqual(scheduler.next_report(0.1), _payload(1, size=12))
+        self.assertAlmostEqual(scheduler.get_stats(0.1)["a"]["refresh_rate"], 10.0)
+
+    def test_packed_reports_leave_the_last_byte_free(self):
+        scheduler = UpdateScheduler(report_size=64, pack_reports=True)
+        scheduler.add_control("\x04\x03\x02\x00")
+        for registration_id in range(7):
+            scheduler.add_update(str(registration_id), _payload(registration_id), 0.0)
+        report = scheduler.next_report(0.0)
+        # 4 + 5 * 10 bytes, a sixth update would end exactly at byte 64
+        self.assertEqual(len(report), 54)
+        self.assertTrue(report.startswith("\x04\x03\x02\x00"))
+        self.assertEqual(len(scheduler.next_report(0.01)), 20)
+
+    def test_pending_updates_count_as_stale(self):
+        self.scheduler.add_update("a", _payload(1), 0.0)
+        self.assertEqual(self.scheduler.get_stats(0.5)["a"]["max_staleness"], 0.5)
+        self.assertEqual(self.scheduler.get_stats(0.5)["a"]["sent"], 0)
@@ -0,0 +1,300 @@
+import base64
+import hashlib
+import json
+import select
+import socket
+import struct
+import threading
+import time
+import unittest
+import zlib
+from kcontroller import packets
+from kcontroller.dataref import DatarefCommand, DatarefFloat
+from kcontroller.exchanges.kerbal_telemachus import KerbalTelemachusExchange
+from kcontroller.exchanges.websocket_transport import WebSocketTransport, WebSocketClosed, WEBSOCKET_GUID
+
+
+def _build_frame(opcode, payload, fin=True, rsv1=False):
+    first_byte = (0x80 if fin else 0) | (0x40 if rsv1 else 0) | opcode
+    if len(payload) < 126:
+        header = struct.pack("!BB", first_byte, len(payload))
+    elif len(payload) < 65536:
+        header = struct.pack("!BBH", first_byte, 126, len(payload))
+    else:
+        header = struct.pack("!BBQ", first_byte, 127, len(payload))
+    return header + payload
+
+
+class _StandInServer(object):
+    """Websocket server on a local port, serving one client per call to serve() from its own thread."""
+
+    def __init__(self, deflate=False):
+        self.deflate = deflate
+        self.received = []
+        self.requests = []
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(("127.0.0.1", 0))
+        self._listener.listen(1)
+        self._connection = None
+        self._buffer = ""
+        self._thread = None
+
+    def get_url(self):
+        return "ws://127.0.0.1:%s/datalink" % self._listener.getsockname()[1]
+
+    def serve(self, script):
+        self._thread = threading.Thread(target=self._serve, args=(script, ))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self):
+        self._thread.join(5)
+
+    def close(self):
+        if self._connection:
+            self._connection.close()
+        self._listener.close()
+
+    def _serve(self, script):
+        self._connection, _ = self._listener.accept()
+        while "\r\n\r\n" not in self._buffer:
+            self._buffer += self._connection.recv(4096)
+        request, self._buffer = self._buffer.split("\r\n\r\n", 1)
+        self.requests.append(request)
+        key = [line.split(":", 1)[1].strip() for line in request.split("\r\n")
+               if line.lower().startswith("sec-websocket-key")][0]
+        accept = base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest())
+        extensions = ("Sec-WebSocket-Extensions: permessage-deflate; server_no_context_takeover\r\n"
+                      if self.deflate else "")
+        self._connection.sendall("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                                 "Sec-WebSocket-Accept: %s\r\n%s\r\n" % (accept, extensions))
+        script(self)
+
+    def send_message(self, message, fragments=1, ping=False):
+        data = message
+        if self.deflate:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            data = (compressor.compress(message) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+        size = len(data) // fragments + 1
+        frames = ""
+        for index in range(fragments):
+            frames += _build_frame(0x1 if index == 0 else 0x0, data[index * size:(index + 1) * size],
+                                   fin=index == fragments - 1, rsv1=self.deflate and index == 0)
+            if ping and index == 0:
+                # control frames may arrive between the fragments of a message
+                frames += _build_frame(0x9, "ping")
+        return frames
+
+    def trickle(self, data, chunk_size=7):
+        for index in range(0, len(data), chunk_size):
+            self._connection.sendall(data[index:index + chunk_size])
+            if index % (chunk_size * 100) == 0:
+                time.sleep(0.001)
+
+    def read_frame(self):
+        while True:
+            if len(self._buffer) >= 2:
+                length = ord(self._buffer[1]) & 0x7f
+                header_size = 2
+                if length == 126:
+                    length, header_size = struct.unpack("!H", self._buffer[2:4])[0], 4
+                elif length == 127:
+                    length, header_size = struct.unpack("!Q", self._buffer[2:10])[0], 10
+                if len(self._buffer) >= header_size + 4 + length:
+                    mask = bytearray(self._buffer[header_size:header_size + 4])
+                    payload = bytearray(self._buffer[header_size + 4:header_size + 4 + length])
+                    for index in range(length):
+                        payload[index] ^= mask[index & 3]
+                    opcode = ord(self._buffer[0])
+                    self._buffer = self._buffer[header_size + 4 + length:]
+                    if opcode & 0x40:
+                        payload = zlib.decompressobj(-15).decompress(str(payload) + "\x00\x00\xff\xff")
+                    self.received.append((opcode & 0x0f, str(payload)))
+                    return opcode & 0x0f, str(payload)
+            data = self._connection.recv(4096)
+            if not data:
+                return None, None
+            self._buffer += data
+
+    def send_close(self):
+        self._connection.sendall(_build_frame(0x8, struct.pack("!H", 1000)))
+
+
+def _run_until(transport, poller, condition, timeout=5.0):
+    messages = []
+    deadline = time.time() + timeout
+    while not condition(messages) and time.time() < deadline:
+        poller.poll(100)
+        messages.extend(transport.receive())
+        transport.flush()
+    return messages
+
+
+class WebSocketTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.transports = []
+
+    def tearDown(self):
+        for transport in self.transports:
+            transport.close()
+        self.server.close()
+
+    def _connect(self):
+        transport = WebSocketTransport(self.server.get_url())
+        self.transports.append(transport)
+        transport.connect()
+        poller = select.poll()
+        poller.register(transport, select.POLLOUT)
+        self.assertTrue(poller.poll(1000))
+        transport.handle_connected()
+        poller.modify(transport, select.POLLIN)
+        transport.flush()
+        # messages sent right after the handshake can arrive with it
+        messages = _run_until(transport, poller, lambda messages: transport.is_open())
+        self.assertTrue(transport.is_open())
+        return transport, poller, messages
+
+    def _check_trickled_messages(self, deflate):
+        expected = [json.dumps({"v.altitude": index * 1.5, "pad": "x" * (index * 50)}) for index in range(20)]
+        expected.append("y" * 70000)
+
+        def script(server):
+            frames = "".join(server.send_message(message, fragments=2, ping=True) for message in expected[:-1])
+            server.trickle(frames + server.send_message(expected[-1]))
+            while server.read_frame()[0] != 0x1:
+                pass
+
+        self.server = _StandInServer(deflate=deflate)
+        self.server.serve(script)
+        transport, poller, messages = self._connect()
+        self.assertEqual(transport.is_compressed(), deflate)
+        messages += _run_until(transport, poller, lambda received: len(messages) + len(received) == len(expected))
+        self.assertEqual(messages, expected)
+
+        transport.send('{"+":["v.altitude"]}')
+        transport.flush()
+        self.server.join()
+        self.assertIn((0xa, "ping"), self.server.received)
+        self.assertEqual(self.server.received[-1], (0x1, '{"+":["v.altitude"]}'))
+
+    def test_fragmented_trickled_messages(self):
+        self._check_trickled_messages(False)
+
+    def test_compressed_fragmented_trickled_messages(self):
+        self._check_trickled_messages(True)
+
+    def test_server_close_is_reported_after_pending_messages(self):
+        def script(server):
+            server.read_frame()
+            server._connection.sendall(server.send_message("last"))
+            server.send_close()
+            server.read_frame()
+
+        self.server = _StandInServer()
+        self.server.serve(script)
+        transport, poller, _ = self._connect()
+        transport.send("first")
+        transport.flush()
+        messages = _run_until(transport, poller, lambda messages: messages)
+        self.assertEqual(messages, ["last"])
+        poller.poll(1000)
+        self.assertRaises(WebSocketClosed, transport.receive)
+        transport.flush()
+        self.server.join()
+        self.assertEqual(self.server.received[-1][0], 0x8)
+
+    def test_refused_handshake(self):
+        self.server = _StandInServer()
+
+        def serve():
+            connection, _ = self.server._listener.accept()
+            connection.recv(4096)
+            connection.sendall("HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+            connection.close()
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        transport = WebSocketTransport(self.server.get_url())
+        self.transports.append(transport)
+        transport.connect()
+        poller = select.poll()
+        poller.register(transport, select.POLLOUT)
+        poller.poll(1000)
+        transport.handle_connected()
+        transport.flush()
+        poller.modify(transport, select.POLLIN)
+        poller.poll(1000)
+        self.assertRaises(IOError, transport.receive)
+        thread.join()
+
+
+class _Listener(object):
+    def __init__(self):
+        self.states = []
+
+    def __call__(self, running):
+        self.states.append(running)
+
+
+class KerbalTelemachusExchangeTest(unittest.TestCase):
+    def setUp(self):
+        self.server = _StandInServer()
+        self.listener = _Listener()
+        self.exchange = KerbalTelemachusExchange(self.server.get_url(), reconnect_interval=0.05,
+                                                 max_reconnect_interval=0.2)
+        self.exchange.start(select.poll(), simulation_listener=self.listener)
+
+    def tearDown(self):
+        self.exchange.stop()
+        self.server.close()
+
+    def _run_until(self, condition, timeout=5.0):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            poll_timeout = self.exchange.get_poll_timeout()
+            self.exchange.handle_activity(self.exchange._poller.poll(min(poll_timeout, 50)
+                                                                     if poll_timeout is not None else 50))
+            self.exchange.handle_timers()
+        return condition()
+
+    def test_reconnects_and_resubscribes_after_the_server_closes(self):
+        self.exchange.handle_panel_packet(packets.DataSubscribeRequest(DatarefFloat("v.altitude", None)))
+
+        def close_after_subscription(server):
+            server.read_frame()
+            server._connection.close()
+
+        self.server.serve(close_after_subscription)
+        self.assertTrue(self._run_until(lambda: self.listener.states == [True, False]))
+        self.server.join()
+        self.assertEqual(self.server.received, [(0x1, '{"+":["v.altitude"]}')])
+
+        self.server.received = []
+        self.server._buffer = ""
+        self.server.serve(lambda server: server.read_frame())
+        self.assertTrue(self._run_until(lambda: self.listener.states == [True, False, True]))
+        self.server.join()
+        self.assertEqual(self.server.received, [(0x1, '{"+":["v.altitude"]}')])
+
+    def test_requests_are_dropped_while_disconnected(self):
+        self.exchange.handle_panel_packet(packets.CommandOnce(DatarefCommand("f.stage", None)))
+        self.exchange.handle_panel_packet(packets.DataSubscribeRequest(DatarefFloat("v.altitude", None)))
+        self.assertEqual(self.exchange._pending_requests, [])
+        self.assertEqual(self.exchange._subscriptions.keys(), ["v.altitude"])
+
+    def test_repeated_subscriptions_are_sent_once(self):
+        self.server.serve(lambda server: server.read_frame())
+        self.assertTrue(self._run_until(lambda: self.listener.states == [True]))
+        for name in ("v.altitude", "v.altitude", "sim/cockpit/sas/state", "v.sasValue"):
+            self.exchange.handle_panel_packet(packets.DataSubscribeRequest(DatarefFloat(name, None)))
+        self.exchange.handle_panel_packet(packets.CommandOnce(DatarefCommand("f.stage", None)))
+        self.assertTrue(self._run_until(lambda: len(self.server.received) == 1))
+        self.assertEqual(json.loads(self.server.received[0][1]),
+                         {"+": ["v.altitude", "v.sasValue"], "run": ["f.stage"]})
+
+    def test_backs_off_while_the_server_is_down(self):
+        self.server.close()
+        self._run_until(lambda: self.exchange._retry_interval == 0.2, timeout=2.0)
+        self.assertEqual(self.exchange._retry_interval, 0.2)
+        self.assertEqual(self.listener.states, [])
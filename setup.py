@@ -13,7 +13,7 @@ setup(
     install_requires=[
         'Flask==0.10.1',
         'gunicorn==19.1.0',
-        'websocket-client==0.16.0a',
+        'PyYAML==3.11',
     ],
     packages=find_packages(
         exclude=[
@@ -26,6 +26,7 @@ setup(
     },
     package_data={
         'kcontroller': [
+            'resources/config/*',
             'resources/upstart-script',
         ]
     }